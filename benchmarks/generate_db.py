@@ -0,0 +1,97 @@
+"""Generate synthetic dataset-*.db files with the DATA/METADATA schema of the
+bundled databases, for benchmarking."""
+import argparse
+import sqlite3
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from mippy.database import create_indexes
+
+CHUNK_ROWS = 100_000
+
+METADATA_SQL = """
+CREATE TABLE metadata (
+    code TEXT NOT NULL,
+    label TEXT,
+    sql_type TEXT,
+    "isCategorical" INTEGER,
+    enumerations TEXT,
+    min INTEGER,
+    max INTEGER,
+    PRIMARY KEY (code)
+)
+"""
+
+LABELS = ["A", "B"]
+GROUPS = ["g0", "g1", "g2"]
+
+
+def feature_names(n_columns: int) -> List[str]:
+    return [f"x{i}" for i in range(n_columns)]
+
+
+def generate_databases(
+    db_root: Path, n_servers: int, n_rows: int, n_columns: int, seed: int = 0
+) -> List[str]:
+    """Write dataset-bench<i>.db for every server and return the server names.
+
+    Every server holds one dataset, bench<i>, of `n_rows` rows with numerical
+    features x0, x1, ..., a numerical target y, a binary categorical label and
+    a three-level categorical group.
+    """
+    db_root.mkdir(parents=True, exist_ok=True)
+    names = [f"bench{i}" for i in range(n_servers)]
+    rng = np.random.default_rng(seed)
+    coeff = rng.normal(size=n_columns) / np.sqrt(n_columns)
+    for name in names:
+        db_path = db_root / f"dataset-{name}.db"
+        db_path.unlink(missing_ok=True)
+        with sqlite3.connect(db_path) as conn:
+            for start in range(0, n_rows, CHUNK_ROWS):
+                size = min(CHUNK_ROWS, n_rows - start)
+                chunk = make_chunk(rng, coeff, size, dataset=name)
+                chunk.to_sql("data", conn, if_exists="append", index=False)
+            conn.execute(METADATA_SQL)
+            conn.executemany(
+                "INSERT INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)",
+                metadata_rows(n_columns, names),
+            )
+        conn.close()
+        create_indexes(db_path, [])
+    return names
+
+
+def make_chunk(
+    rng: np.random.Generator, coeff: np.ndarray, size: int, dataset: str
+) -> pd.DataFrame:
+    X = rng.normal(size=(size, len(coeff)))
+    z = X @ coeff
+    data = pd.DataFrame(X, columns=feature_names(len(coeff)))
+    data["y"] = z + rng.normal(size=size)
+    data["label"] = np.where(rng.random(size) < 1 / (1 + np.exp(-z)), "B", "A")
+    data["group"] = rng.choice(GROUPS, size=size)
+    data["dataset"] = dataset
+    return data
+
+
+def metadata_rows(n_columns: int, datasets: List[str]) -> list:
+    rows = [(col, col, "real", 0, None, None, None) for col in feature_names(n_columns)]
+    rows.append(("y", "y", "real", 0, None, None, None))
+    rows.append(("label", "label", "text", 1, ",".join(LABELS), None, None))
+    rows.append(("group", "group", "text", 1, ",".join(GROUPS), None, None))
+    rows.append(("dataset", "Dataset", "text", 1, ",".join(datasets), None, None))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db-root", type=Path, default=Path("bench-dbs"))
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_databases(args.db_root, args.servers, args.rows, args.columns, args.seed)
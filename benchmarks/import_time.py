@@ -0,0 +1,110 @@
+"""Measure how long it takes to import mippy.
+
+Runs every statement in a fresh interpreter `--repeat` times and reports the
+median wall time, with the modules taking longest to import according to
+`python -X importtime`. Pass `--compare` with an earlier result file to print
+the ratios.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+root = Path(__file__).parent.parent
+
+STATEMENTS = {
+    "package": "import mippy",
+    "master": "from mippy import WorkerPool",
+    "algorithm": "from mippy.machinelearning import PCAMaster",
+    "server": "from mippy.server import Server",
+    "all": "from mippy import *; from mippy.machinelearning import reduction_rules",
+}
+
+
+def environment() -> Dict[str, str]:
+    # algorithm modules import `master`
+    paths = [str(root), str(root / "mippy"), os.environ.get("PYTHONPATH", "")]
+    return {**os.environ, "PYTHONPATH": os.pathsep.join(paths)}
+
+
+def time_import(statement: str) -> float:
+    code = f"import time; t = time.perf_counter(); {statement}; "
+    code += "print(time.perf_counter() - t)"
+    cmd = [sys.executable, "-c", code]
+    return float(subprocess.check_output(cmd, env=environment(), text=True))
+
+
+def slowest_modules(statement: str, count: int) -> List[tuple]:
+    cmd = [sys.executable, "-X", "importtime", "-c", statement]
+    output = subprocess.run(
+        cmd, env=environment(), capture_output=True, text=True, check=True
+    ).stderr
+    modules = []
+    for line in output.splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        if not name.startswith("  "):  # imported by the statement itself
+            modules.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(modules, key=lambda module: -module[1])[:count]
+
+
+def run_benchmarks(repeat: int, top: int) -> dict:
+    results = {}
+    for name, statement in STATEMENTS.items():
+        times = [time_import(statement) for _ in range(repeat)]
+        results[name] = {
+            "statement": statement,
+            "times": times,
+            "median": statistics.median(times),
+            "slowest": slowest_modules(statement, top),
+        }
+        print(f"{name:<10} {results[name]['median']:.4f}s  {statement}")
+        for module, seconds in results[name]["slowest"]:
+            print(f"{'':<12}{seconds:.4f}s  {module}")
+    return results
+
+
+def compare(results: dict, baseline: dict) -> None:
+    print("\nratio to baseline (new / old)")
+    for name, result in results.items():
+        if name in baseline["results"]:
+            ratio = result["median"] / baseline["results"][name]["median"]
+            print(f"{name:<10} {ratio:.4f}")
+
+
+def git_commit() -> str:
+    try:
+        cmd = ["git", "rev-parse", "HEAD"]
+        return subprocess.check_output(cmd, cwd=root, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--top", type=int, default=5, help="slowest modules shown")
+    parser.add_argument("--output", type=Path, default=Path("import-time.json"))
+    parser.add_argument("--compare", type=Path, help="earlier result file")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.repeat, args.top)
+    output = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    args.output.write_text(json.dumps(output, indent=2))
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
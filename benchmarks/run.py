@@ -0,0 +1,230 @@
+"""Benchmark every algorithm end to end on a synthetic federation.
+
+Generates the databases, starts a private name server and one server process
+per database, runs each master `--repeat` times and writes wall time and
+per-phase times (data load, compute, serialization, rpc, reduce) to a JSON
+file. Pass `--compare` with an earlier result file to print the ratios.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+root = Path(__file__).parent.parent
+sys.path.insert(0, str(root / "mippy"))  # algorithm modules import `master`
+
+import Pyro5.api  # noqa: E402
+from addict import Dict as AttrDict  # noqa: E402
+
+from generate_db import feature_names, generate_databases  # noqa: E402
+from mippy.machinelearning import (  # noqa: E402
+    KMeansMaster,
+    LinearRegressionMaster,
+    LogisticRegressionMaster,
+    NaiveBayesMaster,
+    PCAMaster,
+    PearsonMaster,
+)
+from mippy.tracing import collect_spans, enable_tracing, summarize  # noqa: E402
+
+# Outermost server spans, one per request, load, compute and serialize are inside
+REQUEST_SPANS = ["run_on_worker", "run_batch"]
+PHASES = ["wall", "load", "compute", "serialization", "rpc", "transport", "reduce"]
+
+
+def get_algorithms(n_columns: int, datasets: List[str]) -> Dict[str, tuple]:
+    features = feature_names(n_columns)
+    algorithms = {
+        "linear_regression": (
+            LinearRegressionMaster,
+            {"columns": {"target": ["y"], "features": features}},
+        ),
+        "logistic_regression": (
+            LogisticRegressionMaster,
+            {"columns": {"target": ["label"], "features": features}, "outcome": "B"},
+        ),
+        "pca": (PCAMaster, {"columns": {"variables": features}}),
+        "pearson": (PearsonMaster, {"columns": {"variables": features}}),
+        "kmeans": (KMeansMaster, {"columns": {"features": features}, "k": 3}),
+        "naive_bayes": (
+            NaiveBayesMaster,
+            {
+                "columns": {"target": ["label"], "features": ["group"]},
+                "alpha": {"value": 0.5},
+            },
+        ),
+    }
+    common = {"datasets": datasets, "filter": None}
+    return {
+        name: (master_cls, AttrDict({**common, **params}))
+        for name, (master_cls, params) in algorithms.items()
+    }
+
+
+@contextlib.contextmanager
+def federation(db_root: Path, names: List[str]) -> Iterator[None]:
+    port = free_port()
+    os.environ["PYRO_NS_PORT"] = str(port)
+    Pyro5.config.NS_PORT = port
+    procs = [
+        subprocess.Popen(
+            [sys.executable, "-m", "Pyro5.nameserver", "-p", str(port)],
+            stdout=subprocess.DEVNULL,
+        )
+    ]
+    try:
+        wait_for(lambda: Pyro5.api.locate_ns(port=port))
+        for name in names:
+            cmd = [sys.executable, "server.py", f"--servername={name}"]
+            # cached moments would turn every repeat after the first into a lookup
+            cmd += [f"--db-root={db_root}", "--no-stats-cache"]
+            procs.append(
+                subprocess.Popen(cmd, cwd=root / "mippy", stdout=subprocess.DEVNULL)
+            )
+        expected = {f"local-server.{name}" for name in names}
+        wait_for(lambda: expected <= set(Pyro5.api.locate_ns().list()) or None)
+        yield
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+
+def run_benchmarks(names: List[str], n_columns: int, repeat: int, selected) -> dict:
+    servers = {name: Pyro5.api.Proxy(f"PYRONAME:local-server.{name}") for name in names}
+    for proxy in servers.values():
+        proxy.set_tracing(True)
+    enable_tracing(True)
+    results = {}
+    for algorithm, (master_cls, params) in get_algorithms(n_columns, names).items():
+        if selected and algorithm not in selected:
+            continue
+        runs: Dict[str, List[float]] = {phase: [] for phase in PHASES}
+        for _ in range(repeat):
+            collect_spans()
+            for proxy in servers.values():
+                proxy.collect_spans()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                with master_cls(params, servers=names) as master:
+                    master.run()
+            wall = time.perf_counter() - start
+            client = summarize(collect_spans())
+            server = summarize(
+                [span for proxy in servers.values() for span in proxy.collect_spans()]
+            )
+            server_time = sum(server.get(name, 0.0) for name in REQUEST_SPANS)
+            phases = {
+                "wall": wall,
+                "load": server.get("load", 0.0),
+                "compute": server.get("compute", 0.0),
+                "serialization": client.get("serialize", 0.0)
+                + server.get("serialize", 0.0),
+                "rpc": client.get("rpc", 0.0),
+                "transport": client.get("rpc", 0.0) - server_time,
+                "reduce": client.get("reduce", 0.0),
+            }
+            for phase, value in phases.items():
+                runs[phase].append(value)
+        results[algorithm] = {
+            "runs": runs,
+            "median": {phase: statistics.median(v) for phase, v in runs.items()},
+        }
+        print(format_row(algorithm, results[algorithm]["median"]))
+    return results
+
+
+def compare(results: dict, baseline: dict) -> None:
+    print("\nratio to baseline (new / old)")
+    for algorithm, result in results.items():
+        if algorithm not in baseline["results"]:
+            continue
+        old = baseline["results"][algorithm]["median"]
+        ratios = {
+            phase: value / old[phase] if old.get(phase) else float("nan")
+            for phase, value in result["median"].items()
+        }
+        print(format_row(algorithm, ratios, unit=""))
+
+
+def format_row(algorithm: str, values: Dict[str, float], unit: str = "s") -> str:
+    cells = " ".join(f"{phase}={values[phase]:.4f}{unit}" for phase in PHASES)
+    return f"{algorithm:<20} {cells}"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(check, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if check():
+                return
+        except Pyro5.errors.PyroError:
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError("Federation did not start in time.")
+        time.sleep(0.2)
+
+
+def git_commit() -> str:
+    try:
+        cmd = ["git", "rev-parse", "HEAD"]
+        return subprocess.check_output(cmd, cwd=root, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--rows", type=int, default=10_000, help="rows per server")
+    parser.add_argument("--columns", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--algorithms", default="", help="comma separated")
+    parser.add_argument("--db-root", type=Path, help="keep generated dbs here")
+    parser.add_argument("--output", type=Path, default=Path("bench-results.json"))
+    parser.add_argument("--compare", type=Path, help="earlier result file")
+    args = parser.parse_args()
+    selected = [name for name in args.algorithms.split(",") if name]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_root = (args.db_root or Path(tmp)).resolve()
+        names = generate_databases(db_root, args.servers, args.rows, args.columns)
+        with federation(db_root, names):
+            results = run_benchmarks(names, args.columns, args.repeat, selected)
+
+    output = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "servers": args.servers,
+            "rows": args.rows,
+            "columns": args.columns,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    args.output.write_text(json.dumps(output, indent=2))
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,65 @@
-from mippy.worker import *
-from mippy.database import *
-from mippy.server import *
-from mippy.parameters import *
-from mippy.workerproxy import *
-from mippy.machinelearning import *
-from . import worker
-from . import database
-from . import server
-from . import parameters
-from . import workerproxy
-from . import machinelearning
+"""Submodules are imported on first access to one of their names, so that
+`import mippy` does not load pandas, SQLAlchemy, Pyro5 and every algorithm."""
+import importlib
 
+_exports = {
+    "worker": ["Worker", "cpu_bound"],
+    "cache": ["DataCache", "make_key"],
+    "database": ["DataBase"],
+    "filters": ["parse_filter", "compile_filter", "filter_params", "evaluate_filter"],
+    "stats": ["Moments", "StatsCache", "cross_products"],
+    "solvers": ["solve_spd", "solve_from_r"],
+    "columnar": ["ColumnStore"],
+    "processes": ["ComputePool", "SharedFrame", "attach_frame"],
+    "server": ["Server", "start_server"],
+    "aggregator": ["Aggregator", "start_aggregator"],
+    "serialization": ["SERIALIZER", "encode", "payload_size", "set_compression"],
+    "tracing": [
+        "span",
+        "enable_tracing",
+        "tracing_enabled",
+        "collect_spans",
+        "summarize",
+        "export_chrome_trace",
+        "export_otel_trace",
+    ],
+    "parameters": ["get_parameters", "get_columns", "get_models"],
+    "connections": ["ConnectionManager", "connection_manager"],
+    "workerproxy": ["WorkerProxy", "WorkerPool", "AsyncWorkerPool", "run_sync"],
+    "machinelearning": [
+        "LogisticRegressionMaster",
+        "LogisticRegressionWorker",
+        "PCAWorker",
+        "PCAMaster",
+        "NaiveBayesWorker",
+        "NaiveBayesMaster",
+        "LinearRegressionMaster",
+        "LinearRegressionWorker",
+        "KMeansMaster",
+        "KMeansWorker",
+        "PearsonWorker",
+        "PearsonMaster",
+        "reduction_rules",
+        "algorithms",
+        "load_algorithm",
+        "get_class",
+        "get_rules",
+    ],
+}
+_origins = {name: module for module, names in _exports.items() for name in names}
 
-__all__ = []
-__all__.extend(worker.__all__)
-__all__.extend(database.__all__)
-__all__.extend(server.__all__)
-__all__.extend(parameters.__all__)
-__all__.extend(workerproxy.__all__)
-__all__.extend(machinelearning.__all__)
+__all__ = list(_origins)
+
+
+def __getattr__(name: str):
+    if name in _exports:
+        return importlib.import_module(f"mippy.{name}")
+    if name in _origins:
+        value = getattr(importlib.import_module(f"mippy.{_origins[name]}"), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted({*globals(), *_exports, *__all__})
@@ -0,0 +1,123 @@
+import functools
+import operator
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Mapping, Optional
+
+import Pyro5.api
+import Pyro5.callcontext
+
+from mippy.connections import connection_manager
+from mippy.reduce import BatchReducer, Reducer, fold_results
+from mippy.serialization import encode
+from mippy.tracing import collect_spans, enable_tracing, span
+
+__all__ = ["Aggregator", "start_aggregator"]
+
+
+class Aggregator:
+    """Intermediate node of a reduction tree.
+
+    Looks like a server to a `WorkerPool`: each call is forwarded to all
+    children, servers or other aggregators, and their results are folded
+    here, so that the master receives one partial result per aggregator.
+    """
+
+    def __init__(self, name: str, children: List[str]):
+        self.name = name
+        print(f"Starting aggregator {name} over {', '.join(children)}")
+        self.children = [f"local-server.{child}" for child in children]
+        self._executor = ThreadPoolExecutor(max_workers=max(len(children), 1))
+
+    def call(self, child: str, method: str, *args, **kwargs) -> Any:
+        return connection_manager.call(child, method, *args, **kwargs)
+
+    def call_all(self, method: str, *args, **kwargs) -> list:
+        return list(
+            self._executor.map(
+                lambda child: self.call(child, method, *args, **kwargs),
+                self.children,
+            )
+        )
+
+    @Pyro5.api.expose
+    def run_on_worker(
+        self, session: str, params: Mapping, task: str, method: str, *args, **kwargs
+    ) -> Any:
+        from mippy.machinelearning import get_rules
+
+        request = Pyro5.callcontext.current_context.correlation_id
+        trace = {"server": self.name, "session": session}
+
+        def forward(child: str) -> Any:
+            Pyro5.callcontext.current_context.correlation_id = request
+            return self.call(child, "run_on_worker", session, *payload, **kwargs)
+
+        with span("run_on_worker", request=str(request), **trace):
+            payload = encode((params, task, method, *args))
+            kwargs = encode(kwargs)
+            reducer = Reducer(get_rules(task)[method])
+            fold_results(self._executor, self.children, forward, reducer, **trace)
+            return encode(tuple(reducer.values))
+
+    @Pyro5.api.expose
+    def run_batch(
+        self, session: str, params: Mapping, task: str, calls: List[list]
+    ) -> List[Any]:
+        from mippy.machinelearning import get_rules
+
+        request = Pyro5.callcontext.current_context.correlation_id
+        trace = {"server": self.name, "session": session}
+
+        def forward(child: str) -> Any:
+            Pyro5.callcontext.current_context.correlation_id = request
+            return self.call(child, "run_batch", session, params, task, calls)
+
+        with span("run_batch", request=str(request), **trace):
+            params, calls = encode(params), encode(calls)
+            rules = [get_rules(task)[method] for method, _, _ in calls]
+            reducer = BatchReducer(rules)
+            fold_results(self._executor, self.children, forward, reducer, **trace)
+            return [encode(tuple(values)) for values in reducer.values]
+
+    @Pyro5.api.expose
+    def close_session(self, session: str) -> None:
+        self.call_all("close_session", session)
+
+    @Pyro5.api.expose
+    def get_datasets(self) -> set:
+        return functools.reduce(operator.or_, self.call_all("get_datasets"), set())
+
+    @Pyro5.api.expose
+    def set_tracing(self, enabled: bool, log: bool = False) -> None:
+        enable_tracing(enabled, log=log)
+        self.call_all("set_tracing", enabled, log)
+
+    @Pyro5.api.expose
+    def collect_spans(self, session: Optional[str] = None) -> List[dict]:
+        spans = collect_spans(session)
+        for child_spans in self.call_all("collect_spans", session):
+            spans.extend(child_spans)
+        return spans
+
+
+def start_aggregator(name: str, children: List[str]) -> None:
+    daemon = Pyro5.api.Daemon()
+    ns = Pyro5.api.locate_ns()
+    aggregator = Aggregator(name, children)
+    ns.register(f"local-server.{name}", daemon.register(aggregator))
+    daemon.requestLoop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--name")
+    parser.add_argument("--children", help="comma separated server names")
+    parser.add_argument("--compress-above", type=int, help="KB")
+    args = parser.parse_args()
+    if args.compress_above is not None:
+        from mippy.serialization import set_compression
+
+        set_compression(args.compress_above * 1024)
+    start_aggregator(args.name, [child for child in args.children.split(",") if child])
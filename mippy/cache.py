@@ -0,0 +1,118 @@
+import json
+import threading
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, Hashable, List, Mapping, Optional, Set, Tuple
+
+from addict import Dict as AttrDict
+
+from mippy.parameters import get_columns
+
+__all__ = ["DataCache", "make_key"]
+
+
+def make_key(worker_kind: str, params: Mapping) -> Tuple:
+    columns = sorted(get_columns(AttrDict(params)))  # the columns loaded
+    datasets = params["datasets"]
+    if not isinstance(datasets, str):
+        datasets = tuple(sorted(set(datasets)))
+    filter_ = json.dumps(params.get("filter"), sort_keys=True)
+    streaming = bool(params.get("streaming"))
+    return worker_kind, tuple(columns), datasets, filter_, streaming
+
+
+class DataCache:
+    """LRU cache of loaded workers bounded by a memory budget in bytes.
+
+    Every entry is tracked by the sessions that used it, so that a master can
+    release its data explicitly with `close_session` when a run is over.
+    """
+
+    def __init__(
+        self, max_bytes: int, on_evict: Optional[Callable[[Any], None]] = None
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.nbytes = 0
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._sessions: Dict[str, Set[Hashable]] = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"{cls}(entries={len(self)}, nbytes={self.nbytes})"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable, session: str) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            self._sessions[session].add(key)
+            return self._entries[key][0]
+
+    def put(self, key: Hashable, value: Any, nbytes: int, session: str) -> None:
+        with self._lock:
+            evicted = self._pop(key)
+            if nbytes <= self.max_bytes:
+                self._entries[key] = (value, nbytes)
+                self._sessions[session].add(key)
+                self.nbytes += nbytes
+                evicted += self._shrink()
+        self._release(evicted)
+
+    def resize(self, key: Hashable, nbytes: int) -> None:
+        """Account for an entry that grew or shrank after it was stored."""
+        with self._lock:
+            if key not in self._entries:
+                return
+            value, old_nbytes = self._entries[key]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes - old_nbytes
+            evicted = self._pop(key) if nbytes > self.max_bytes else []
+            evicted += self._shrink()
+        self._release(evicted)
+
+    def evict(self, key: Hashable) -> None:
+        with self._lock:
+            evicted = self._pop(key)
+        self._release(evicted)
+
+    def close_session(self, session: str) -> None:
+        with self._lock:
+            keys = self._sessions.pop(session, set())
+            in_use = set().union(*self._sessions.values())
+            evicted = [value for key in keys - in_use for value in self._pop(key)]
+        self._release(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            evicted = [value for key in list(self._entries) for value in self._pop(key)]
+        self._release(evicted)
+
+    def _pop(self, key: Hashable) -> List[Any]:
+        if key not in self._entries:
+            return []
+        value, nbytes = self._entries.pop(key)
+        self.nbytes -= nbytes
+        for session in list(self._sessions):
+            self._sessions[session].discard(key)
+            if not self._sessions[session]:
+                del self._sessions[session]
+        return [value]
+
+    def _shrink(self) -> List[Any]:
+        evicted = []
+        while self.nbytes > self.max_bytes and self._entries:
+            evicted += self._pop(next(iter(self._entries)))
+        return evicted
+
+    def _release(self, evicted: List[Any]) -> None:
+        # outside of the lock, so that on_evict may take locks of its own
+        if self.on_evict is not None:
+            for value in evicted:
+                self.on_evict(value)
@@ -0,0 +1,177 @@
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+
+from mippy.filters import evaluate_filter, filter_columns, parse_filter
+
+__all__ = ["ColumnStore"]
+
+MANIFEST = "manifest.json"
+EXPORT_GROUP_SIZE = 64  # columns read from SQLite at a time while exporting
+
+
+class ColumnStore:
+    """Columnar copy of the DATA table of a database, one memory-mapped array
+    per column plus a row index per dataset.
+
+    Numerical columns are stored as they are, with NULL as NaN. Any other
+    column is stored as int32 codes into a vocabulary, with -1 for missing
+    values. The copy is exported again whenever the database file changes.
+    Each read works on a `Snapshot` of the arrays it needs, mapped under the
+    lock, so that an export in another thread never mixes two versions.
+    """
+
+    def __init__(self, db, path: Path) -> None:
+        self.db = db
+        self.path = path
+        self._current: Optional[Snapshot] = None
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"{cls}({self.path})"
+
+    def read(
+        self, columns: List[str], datasets: List[str], filter_: Optional[Mapping]
+    ) -> pd.DataFrame:
+        snapshot, rows = self.select_rows(columns, datasets, filter_)
+        return snapshot.build_frame(columns, rows)
+
+    def iter_chunks(
+        self,
+        columns: List[str],
+        datasets: List[str],
+        filter_: Optional[Mapping],
+        chunksize: int,
+    ) -> Iterator[pd.DataFrame]:
+        snapshot, rows = self.select_rows(columns, datasets, filter_)
+        for start in range(0, len(rows), chunksize):
+            yield snapshot.build_frame(columns, rows[start : start + chunksize])
+
+    def count_rows(self, datasets: List[str], filter_: Optional[Mapping]) -> int:
+        return len(self.select_rows([], datasets, filter_)[1])
+
+    def select_rows(
+        self, columns: List[str], datasets: List[str], filter_: Optional[Mapping]
+    ) -> Tuple["Snapshot", np.ndarray]:
+        shape, values = parse_filter(filter_)
+        snapshot = self.snapshot(columns + filter_columns(shape), datasets)
+        rows = np.sort(
+            np.concatenate(
+                [snapshot.rows[ds] for ds in datasets if ds in snapshot.rows]
+                or [np.array([], dtype=np.int64)]
+            )
+        )
+        if shape is not None:
+            get_column = lambda col: snapshot.decode(col, snapshot.arrays[col][rows])
+            rows = rows[evaluate_filter(shape, values, get_column)]
+        return snapshot, rows
+
+    def snapshot(self, columns: List[str], datasets: List[str]) -> "Snapshot":
+        """Map the given columns and dataset indexes of the current version.
+        Mapped arrays stay readable after a later export removes their files."""
+        version = self.db.version()
+        with self._lock:
+            if self._current is None and (self.path / MANIFEST).exists():
+                manifest = json.loads((self.path / MANIFEST).read_text())
+                self._current = Snapshot(manifest)
+            if self._current is None or self._current.manifest["version"] != version:
+                self._current = Snapshot(self.export(version))
+            current = self._current
+            for col in columns:
+                if col not in current.arrays:
+                    file = current.manifest["columns"][col]["file"]
+                    current.arrays[col] = self.load(file)
+            index = current.manifest["datasets"]
+            for ds in datasets:
+                if ds in index and ds not in current.rows:
+                    current.rows[ds] = self.load(index[ds])
+            return Snapshot(
+                current.manifest,
+                {col: current.arrays[col] for col in columns},
+                {ds: current.rows[ds] for ds in datasets if ds in current.rows},
+                current.vocabularies,
+            )
+
+    def load(self, name: str) -> np.ndarray:
+        return np.load(self.path / name, mmap_mode="r")
+
+    def export(self, version: List[int]) -> dict:
+        tmp_path = self.path.with_name(self.path.name + f".tmp{os.getpid()}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        table = self.db.data_table
+        names = [col.name for col in table.columns]
+        manifest: dict = {"version": version, "columns": {}, "datasets": {}}
+        for start in range(0, len(names), EXPORT_GROUP_SIZE):
+            group = names[start : start + EXPORT_GROUP_SIZE]
+            frame = pd.read_sql(select([table.c[col] for col in group]), self.db.engine)
+            for i, col in enumerate(group, start=start):
+                manifest["columns"][col] = export_column(frame[col], tmp_path, i)
+        codes = np.load(tmp_path / manifest["columns"]["dataset"]["file"])
+        for code, dataset in enumerate(manifest["columns"]["dataset"]["vocabulary"]):
+            name = f"dataset{code}.npy"
+            np.save(tmp_path / name, np.flatnonzero(codes == code))
+            manifest["datasets"][str(dataset)] = name
+        (tmp_path / MANIFEST).write_text(json.dumps(manifest))
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(tmp_path, self.path)
+        return manifest
+
+
+class Snapshot:
+    def __init__(
+        self,
+        manifest: dict,
+        arrays: Optional[Dict[str, np.ndarray]] = None,
+        rows: Optional[Dict[str, np.ndarray]] = None,
+        vocabularies: Optional[Dict[str, np.ndarray]] = None,
+    ) -> None:
+        self.manifest = manifest
+        self.arrays = {} if arrays is None else arrays
+        self.rows = {} if rows is None else rows
+        self.vocabularies = {} if vocabularies is None else vocabularies
+
+    def build_frame(self, columns: List[str], rows: np.ndarray) -> pd.DataFrame:
+        data = {col: self.arrays[col][rows] for col in columns}
+        present = np.ones(len(rows), dtype=bool)
+        for col, values in data.items():
+            present &= ~self.isnull(col, values)
+        data = pd.DataFrame(
+            {col: self.decode(col, values[present]) for col, values in data.items()},
+            columns=columns,
+        )
+        return data
+
+    def isnull(self, column: str, values: np.ndarray) -> np.ndarray:
+        if self.manifest["columns"][column]["kind"] == "codes":
+            return values < 0
+        if values.dtype.kind == "f":
+            return np.isnan(values)
+        return np.zeros(len(values), dtype=bool)
+
+    def decode(self, column: str, values: np.ndarray) -> np.ndarray:
+        if self.manifest["columns"][column]["kind"] != "codes":
+            return values
+        if column not in self.vocabularies:
+            vocabulary = self.manifest["columns"][column]["vocabulary"]
+            self.vocabularies[column] = np.array(vocabulary + [None], dtype=object)
+        return self.vocabularies[column][values]
+
+
+def export_column(column: pd.Series, path: Path, index: int) -> dict:
+    name = f"column{index}.npy"
+    if column.dtype.kind in "biuf":
+        np.save(path / name, column.to_numpy())
+        return {"file": name, "kind": "values"}
+    column = column.replace("", np.nan)
+    codes, vocabulary = pd.factorize(column)
+    np.save(path / name, codes.astype(np.int32))
+    return {"file": name, "kind": "codes", "vocabulary": vocabulary.tolist()}
@@ -0,0 +1,157 @@
+import select
+import socket
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import Pyro5.api
+import Pyro5.errors
+
+from mippy.serialization import SERIALIZER
+
+__all__ = ["ConnectionManager", "ConnectError", "connection_manager"]
+
+DATASETS_TTL = 60.0  # seconds
+MAX_IDLE = 8  # pooled proxies per server
+
+
+class ConnectError(Pyro5.errors.CommunicationError):
+    """A server could not be reached, the request was not sent."""
+
+
+class ConnectionManager:
+    """Process-wide connections to servers.
+
+    Names are resolved once through the name server and proxies are pooled
+    per server, so that successive pools and masters reuse open connections.
+    Pooled connections closed by their server are dropped before use, and a
+    name is resolved again when its server can't be reached, in case it was
+    restarted on another address. Requests themselves are never sent twice:
+    a call failing after it was sent may have run, its error is raised.
+    """
+
+    def __init__(self, datasets_ttl: float = DATASETS_TTL) -> None:
+        self.datasets_ttl = datasets_ttl
+        self._uris: Dict[str, Pyro5.api.URI] = {}
+        self._idle: Dict[str, List[Pyro5.api.Proxy]] = defaultdict(list)
+        self._datasets: Dict[str, Tuple[float, Set[str]]] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"{cls}(servers={sorted(self._uris)})"
+
+    def resolve(self, name: str) -> Pyro5.api.URI:
+        with self._lock:
+            if name in self._uris:
+                return self._uris[name]
+        uri = Pyro5.api.locate_ns().lookup(name)
+        with self._lock:
+            self._uris[name] = uri
+        return uri
+
+    def call(self, name: str, method: str, *args, **kwargs) -> Any:
+        return self.call_within(None, name, method, *args, **kwargs)
+
+    def call_within(
+        self, timeout: Optional[float], name: str, method: str, *args, **kwargs
+    ) -> Any:
+        """Call a server method, raising `Pyro5.errors.TimeoutError` when the
+        server takes more than `timeout` seconds to answer, None waits."""
+        proxy = self.connect(name, timeout)
+        try:
+            result = getattr(proxy, method)(*args, **kwargs)
+        except Pyro5.errors.TimeoutError:
+            proxy._pyroRelease()  # the late reply would come on this connection
+            raise
+        except Pyro5.errors.CommunicationError:
+            proxy._pyroRelease()
+            self.forget(name)
+            raise
+        except BaseException:
+            self.release(name, proxy)
+            raise
+        self.release(name, proxy)
+        return result
+
+    def connect(self, name: str, timeout: Optional[float] = None) -> Pyro5.api.Proxy:
+        """A proxy connected to a server, raising `ConnectError` if it can't
+        be reached at its address, resolved again if it changed, or doesn't
+        complete the handshake within `timeout` seconds."""
+        proxy = self.acquire(name)
+        proxy._pyroTimeout = timeout
+        try:
+            proxy._pyroBind()  # no-op when connected
+            return proxy
+        except Pyro5.errors.CommunicationError as error:
+            proxy._pyroRelease()
+            uri = proxy._pyroUri
+            self.forget(name)
+            if self.resolve(name) != uri:
+                return self.connect(name, timeout)
+            raise ConnectError(str(error)) from error
+
+    def acquire(self, name: str) -> Pyro5.api.Proxy:
+        while True:
+            with self._lock:
+                proxy = self._idle[name].pop() if self._idle[name] else None
+            if proxy is None or is_open(proxy):
+                break
+            proxy._pyroClaimOwnership()
+            proxy._pyroRelease()
+        if proxy is None:
+            proxy = Pyro5.api.Proxy(self.resolve(name))
+            proxy._pyroSerializer = SERIALIZER
+        proxy._pyroClaimOwnership()  # proxies move between threads
+        return proxy
+
+    def release(self, name: str, proxy: Pyro5.api.Proxy) -> None:
+        with self._lock:
+            if len(self._idle[name]) < MAX_IDLE:
+                self._idle[name].append(proxy)
+                return
+        proxy._pyroRelease()
+
+    def forget(self, name: str) -> None:
+        """Drop the address and pooled proxies of a server."""
+        with self._lock:
+            self._uris.pop(name, None)
+            self._datasets.pop(name, None)
+            proxies = self._idle.pop(name, [])
+        for proxy in proxies:
+            proxy._pyroClaimOwnership()
+            proxy._pyroRelease()
+
+    def get_datasets(self, name: str, timeout: Optional[float] = None) -> Set[str]:
+        """Datasets of a server, fetched again once older than the TTL."""
+        with self._lock:
+            cached = self._datasets.get(name)
+        if cached is not None and time.monotonic() - cached[0] < self.datasets_ttl:
+            return cached[1]
+        datasets = set(self.call_within(timeout, name, "get_datasets"))
+        with self._lock:
+            self._datasets[name] = (time.monotonic(), datasets)
+        return datasets
+
+    def close(self) -> None:
+        with self._lock:
+            names = list(self._uris)
+        for name in names:
+            self.forget(name)
+
+
+def is_open(proxy: Pyro5.api.Proxy) -> bool:
+    """Whether the connection of an idle proxy is still open. Servers send
+    nothing unasked, a readable socket was closed or broken."""
+    if proxy._pyroConnection is None:
+        return False
+    sock = proxy._pyroConnection.sock
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        return not readable or sock.recv(1, socket.MSG_PEEK) != b""
+    except (OSError, ValueError):
+        return False
+
+
+connection_manager = ConnectionManager()
@@ -1,62 +1,282 @@
-from typing import List, Mapping, Set, Optional
+import functools
+import sqlite3
+import warnings
+from typing import Hashable, Iterable, Iterator, List, Mapping, Set, Optional, Tuple
 from pathlib import Path
 import numpy as np
 import pandas as pd
 from addict import Dict
-from sqlalchemy import or_, Table, select, create_engine, MetaData
+from sqlalchemy import Table, bindparam, select, create_engine, event, literal_column
+from sqlalchemy import func
+from sqlalchemy import MetaData
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+
+from mippy.columnar import ColumnStore
+from mippy.filters import compile_filter, filter_params, is_numeric, parse_filter
+from mippy.parameters import get_columns
+from mippy.stats import StatsCache
 
 __all__ = ["DataBase"]
 
 root = Path(__file__).parent.parent
 
+BACKENDS = ("sql", "columnar")
+
+DATASET_INDEX = "dataset_index"
+STATEMENT_CACHE_SIZE = 256
+
+# Read-mostly serving: big page cache, memory-mapped reads, no writes
+PRAGMAS = {
+    "mmap_size": 1024 ** 3,
+    "cache_size": -256 * 1024,  # KB
+    "temp_store": "MEMORY",
+    "query_only": "ON",
+}
+
 
 class DataBase(object):
-    def __init__(self, db_path: Path) -> None:
+    def __init__(
+        self,
+        db_path: Path,
+        backend: str = "sql",
+        immutable: bool = False,
+        stats_cache: bool = True,
+    ) -> None:
         self.db_path = db_path
-        self.engine = create_engine(f"sqlite:///{self.db_path}", echo=False)
+        if immutable:
+            url = f"sqlite:///file:{self.db_path}?immutable=1&uri=true"
+        else:
+            url = f"sqlite:///{self.db_path}"
+        self.engine = create_engine(
+            url,
+            echo=False,
+            poolclass=QueuePool,
+            connect_args={"check_same_thread": False},
+        )
+        event.listen(self.engine, "connect", set_pragmas)
+        # Statements are built and compiled once per (columns, filter shape)
+        self.build_select = functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)(
+            self._build_select
+        )
+        self.build_count = functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)(
+            self._build_count
+        )
+        self._executor = self.engine.execution_options(compiled_cache={})
         self.db_metadata = MetaData(self.engine)
         self.data_table = self.create_table("DATA")
         self.metadata_table = self.create_table("METADATA")
+        self.dataset_index: Optional[Table] = None
+        if self.engine.has_table(DATASET_INDEX):
+            self.dataset_index = self.create_table(DATASET_INDEX)
+        if backend not in BACKENDS:
+            raise ValueError(
+                f"Unknown backend '{backend}', expected one of {BACKENDS}."
+            )
+        self.column_store: Optional[ColumnStore] = None
+        if backend == "columnar":
+            store_path = db_path.parent / ".columnar" / db_path.stem
+            self.column_store = ColumnStore(self, store_path)
+        self.stats_cache: Optional[StatsCache] = None
+        if stats_cache:
+            stats_path = db_path.parent / ".stats" / db_path.stem
+            self.stats_cache = StatsCache(stats_path, self.version)
 
     def __repr__(self) -> str:
         name = type(self).__name__
         return "{name}()".format(name=name)
 
     def create_table(self, table_name: str) -> Table:
-        return Table(table_name, self.db_metadata, autoload=True)
+        return reflect_table(table_name, self.db_metadata)
 
     def read_data(self, parameters: Dict) -> pd.DataFrame:
-        columns: List[str] = sum((cols for cols in parameters.columns.values()), [])
-
+        columns = get_columns(parameters)
+        if self.column_store is not None:
+            return self.column_store.read(
+                columns=columns, datasets=parameters.datasets, filter_=parameters.filter
+            )
         data = self.select_columns_from_data(
             columns=columns, datasets=parameters.datasets, filter_=parameters.filter
         )
         return data
 
+    def iter_data(self, parameters: Dict, chunksize: int) -> Iterator[pd.DataFrame]:
+        """Same rows as `read_data`, streamed in chunks of at most `chunksize`
+        rows so that only one chunk is in memory at a time."""
+        columns = get_columns(parameters)
+        if self.column_store is not None:
+            yield from self.column_store.iter_chunks(
+                columns=columns,
+                datasets=parameters.datasets,
+                filter_=parameters.filter,
+                chunksize=chunksize,
+            )
+            return
+        sel_stmt, params = self.prepare_select(
+            columns=columns, datasets=parameters.datasets, filter_=parameters.filter
+        )
+        chunks = pd.read_sql(
+            sel_stmt, self._executor, params=params, chunksize=chunksize
+        )
+        for data in chunks:
+            yield clean_data(data)
+
+    def count_rows(self, parameters: Dict) -> int:
+        """Number of rows in the datasets that pass the filter, including rows
+        that `read_data` drops for missing values."""
+        if self.column_store is not None:
+            return self.column_store.count_rows(parameters.datasets, parameters.filter)
+        shape, values = parse_filter(parameters.filter)
+        params = {"datasets": list(parameters.datasets), **filter_params(values)}
+        return self._executor.execute(self.build_count(shape), params).scalar()
+
+    def version(self) -> List[int]:
+        """Modification time and size of the database file and of its
+        write-ahead log, which change whenever the content does."""
+        version = []
+        for path in (self.db_path, self.db_path.with_name(self.db_path.name + "-wal")):
+            if path.exists() and (stat := path.stat()).st_size:
+                version += [stat.st_mtime_ns, stat.st_size]
+        return version
+
     def select_columns_from_data(
         self, columns: List[str], datasets: List[str], filter_: Optional[Mapping]
     ) -> pd.DataFrame:
-        dataset_clause = or_(*[self.data_table.c.dataset == ds for ds in datasets])
-        sel_stmt = select([self.data_table.c[col] for col in columns]).where(
-            dataset_clause
-        )
-        if filter_:
-            filter_clause = self.build_filter_clause(filter_)
-            sel_stmt = sel_stmt.where(filter_clause)
-        data = pd.read_sql(sel_stmt, self.engine)
-        data.replace("", np.nan, inplace=True)  # fixme remove
-        data = data.dropna()
-        return data
+        sel_stmt, params = self.prepare_select(columns, datasets, filter_)
+        data = pd.read_sql(sel_stmt, self._executor, params=params)
+        return clean_data(data)
 
-    def build_filter_clause(self, filter_: Mapping):
-        values = [v for v in filter_.values()][0]
-        key = [k for k in filter_.keys()][0]
-        return or_(*[self.data_table.c[key] == val for val in values])
+    def prepare_select(
+        self, columns: List[str], datasets: List[str], filter_: Optional[Mapping]
+    ) -> Tuple[Select, dict]:
+        shape, values = parse_filter(filter_)
+        sel_stmt = self.build_select(tuple(columns), shape)
+        params = {"datasets": list(datasets), **filter_params(values)}
+        return sel_stmt, params
+
+    def _build_select(self, columns: Tuple[str, ...], shape: Hashable) -> Select:
+        dataset_clause = self.data_table.c.dataset.in_(
+            bindparam("datasets", expanding=True)
+        )
+        sel_stmt = (
+            select([self.data_table.c[col] for col in columns])
+            .where(dataset_clause)
+            .order_by(literal_column("rowid"))  # table order, whichever index is used
+        )
+        if shape is not None:
+            sel_stmt = sel_stmt.where(compile_filter(shape, self.data_table))
+        return sel_stmt
+
+    def _build_count(self, shape: Hashable) -> Select:
+        sel_stmt = select([func.count()]).where(
+            self.data_table.c.dataset.in_(bindparam("datasets", expanding=True))
+        )
+        if shape is not None:
+            sel_stmt = sel_stmt.where(compile_filter(shape, self.data_table))
+        return sel_stmt
 
     def get_datasets(self) -> Set[str]:
-        stmt = select([self.data_table.c.dataset])
+        if self.dataset_index is not None:
+            stmt = select([self.dataset_index.c.dataset])
+        else:
+            stmt = select([self.data_table.c.dataset]).distinct()
         res = self.engine.execute(stmt)
         datasets = set()
         for row in res:
             datasets.add(str(row[0]))
         return datasets
+
+
+def create_indexes(db_path: Path, columns: Iterable[str]) -> None:
+    """Create (if missing) column indexes and the distinct dataset table.
+
+    Filters compare text columns as `nullif(column, '')`, these are indexed
+    on that expression. The dataset table is kept up to date by triggers on
+    DATA, so that dataset discovery never scans DATA. Servers only read their
+    database, this is run by hand, see `python mippy/database.py --help`.
+    """
+    engine = create_engine(f"sqlite:///{db_path}")
+    table = reflect_table("DATA", MetaData(engine))
+    engine.dispose()
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('CREATE INDEX IF NOT EXISTS "ix_data_dataset" ON data (dataset)')
+        for col in dict.fromkeys(columns):
+            if is_numeric(table.c[col]):
+                conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS "ix_data_{col}" ON data ("{col}")'
+                )
+            else:
+                conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS "ix_data_{col}_present" '
+                    f"ON data (nullif(\"{col}\", ''))"
+                )
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (DATASET_INDEX,),
+        ).fetchone()
+        if not exists:
+            conn.executescript(DATASET_INDEX_SQL)
+    conn.close()
+
+
+def reflect_table(table_name: str, metadata: MetaData) -> Table:
+    with warnings.catch_warnings():  # SQLAlchemy skips the nullif indexes
+        warnings.filterwarnings("ignore", "Skipped unsupported reflection")
+        return Table(table_name, metadata, autoload=True)
+
+
+def clean_data(data: pd.DataFrame) -> pd.DataFrame:
+    data.replace("", np.nan, inplace=True)  # fixme remove
+    return data.dropna()
+
+
+def set_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for name, value in PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+DATASET_INDEX_SQL = f"""
+CREATE TABLE {DATASET_INDEX} (
+    dataset TEXT PRIMARY KEY,
+    num_rows INTEGER NOT NULL
+);
+INSERT INTO {DATASET_INDEX}
+    SELECT dataset, COUNT(*) FROM data WHERE dataset IS NOT NULL GROUP BY dataset;
+CREATE TRIGGER {DATASET_INDEX}_insert AFTER INSERT ON data
+WHEN NEW.dataset IS NOT NULL BEGIN
+    INSERT OR IGNORE INTO {DATASET_INDEX} VALUES (NEW.dataset, 0);
+    UPDATE {DATASET_INDEX} SET num_rows = num_rows + 1
+        WHERE dataset = NEW.dataset;
+END;
+CREATE TRIGGER {DATASET_INDEX}_delete AFTER DELETE ON data
+WHEN OLD.dataset IS NOT NULL BEGIN
+    UPDATE {DATASET_INDEX} SET num_rows = num_rows - 1
+        WHERE dataset = OLD.dataset;
+    DELETE FROM {DATASET_INDEX} WHERE num_rows <= 0;
+END;
+CREATE TRIGGER {DATASET_INDEX}_update AFTER UPDATE OF dataset ON data BEGIN
+    UPDATE {DATASET_INDEX} SET num_rows = num_rows - 1
+        WHERE dataset = OLD.dataset;
+    DELETE FROM {DATASET_INDEX} WHERE num_rows <= 0;
+    INSERT OR IGNORE INTO {DATASET_INDEX} SELECT NEW.dataset, 0
+        WHERE NEW.dataset IS NOT NULL;
+    UPDATE {DATASET_INDEX} SET num_rows = num_rows + 1
+        WHERE dataset = NEW.dataset;
+END;
+"""
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Index databases for serving, writing to them: stop their "
+        "servers first."
+    )
+    parser.add_argument("db_paths", nargs="+", type=Path)
+    parser.add_argument("--index-columns", default="", help="comma separated")
+    args = parser.parse_args()
+    for db_path in args.db_paths:
+        create_indexes(db_path, [col for col in args.index_columns.split(",") if col])
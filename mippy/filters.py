@@ -0,0 +1,171 @@
+import itertools
+import operator
+from typing import Any, Callable, Hashable, List, Mapping, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import Integer, Numeric, Table, and_, bindparam, func, not_, or_
+from sqlalchemy import literal_column
+
+__all__ = [
+    "parse_filter",
+    "compile_filter",
+    "filter_params",
+    "filter_columns",
+    "evaluate_filter",
+]
+
+COMPARISONS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "le": operator.le,
+    "gt": operator.gt,
+    "ge": operator.ge,
+}
+
+# A filter is a JSON-like tree of single-key mappings, for instance
+#   {"and": [{"between": ["subjectage", 60, 80]},
+#            {"in": ["dataset", ["adni", "edsd"]]},
+#            {"not": {"is_null": "gender"}}]}
+# Mappings with several keys are AND-ed and a key that is not an operator
+# is a column name mapped to a list of accepted values, {"gender": ["F"]}.
+
+
+def parse_filter(filter_: Optional[Mapping]) -> Tuple[Hashable, List[Any]]:
+    """Split a filter into its shape and the list of values it compares to.
+
+    The shape has the columns and operators only, so that filters differing
+    in their values only share a compiled statement.
+    """
+    values: List[Any] = []
+
+    def visit(node: Mapping) -> Hashable:
+        if not isinstance(node, Mapping) or not node:
+            raise ValueError(f"Invalid filter {node!r}.")
+        if len(node) > 1:
+            return "and", tuple(visit({key: node[key]}) for key in sorted(node))
+        ((op, arg),) = node.items()
+        if op in ("and", "or"):
+            if not arg:
+                raise ValueError(f"Empty {op!r} in filter.")
+            return op, tuple(visit(child) for child in arg)
+        if op == "not":
+            return op, visit(arg)
+        if op in ("is_null", "not_null"):
+            return op, arg
+        if op in COMPARISONS:
+            column, value = arg
+            values.append(value)
+            return op, column
+        if op == "between":
+            column, low, high = arg
+            values.extend((low, high))
+            return op, column
+        if op == "in":
+            column, accepted = arg
+            values.append(list(accepted))
+            return op, column
+        values.append(list(arg))
+        return "in", op
+
+    if not filter_:
+        return None, values
+    return visit(filter_), values
+
+
+def compile_filter(shape: Hashable, table: Table):
+    """Build a where clause for a filter shape with one bind parameter per value,
+    named filter_0, filter_1, ... in the order of `parse_filter` values."""
+    counter = itertools.count()
+
+    def bind(expanding: bool = False):
+        return bindparam(f"filter_{next(counter)}", expanding=expanding)
+
+    def visit(node):
+        op, arg = node
+        if op == "and":
+            return and_(*map(visit, arg))
+        if op == "or":
+            return or_(*map(visit, arg))
+        if op == "not":
+            return not_(visit(arg))
+        column = missing_as_null(table.c[arg])
+        if op == "is_null":
+            return column.is_(None)
+        if op == "not_null":
+            return column.isnot(None)
+        if op == "between":
+            return column.between(bind(), bind())
+        if op == "in":
+            return column.in_(bind(expanding=True))
+        return COMPARISONS[op](column, bind())
+
+    return visit(shape)
+
+
+def missing_as_null(column):
+    """Empty strings are missing values, as in the columnar store, and not text
+    that SQLite orders above every number. Numeric columns hold none and are
+    left bare. The literal '' lets SQLite use the `nullif(column, '')` indexes
+    of `create_indexes`."""
+    if is_numeric(column):
+        return column
+    return func.nullif(column, literal_column("''"))
+
+
+def is_numeric(column) -> bool:
+    return isinstance(column.type, (Integer, Numeric))
+
+
+def filter_params(values: List[Any]) -> dict:
+    return {f"filter_{i}": value for i, value in enumerate(values)}
+
+
+def filter_columns(shape: Hashable) -> List[str]:
+    if shape is None:
+        return []
+    op, arg = shape
+    if op in ("and", "or"):
+        return [col for child in arg for col in filter_columns(child)]
+    if op == "not":
+        return filter_columns(arg)
+    return [arg]
+
+
+def evaluate_filter(
+    shape: Hashable, values: List[Any], get_column: Callable[[str], np.ndarray]
+) -> np.ndarray:
+    """Evaluate a filter on in-memory columns with SQL semantics, a comparison
+    with a missing value being neither true nor false."""
+    values_iter = iter(values)
+
+    def visit(node) -> Tuple[np.ndarray, np.ndarray]:
+        op, arg = node
+        if op in ("and", "or"):
+            trues, falses = zip(*map(visit, arg))
+            if op == "and":
+                return np.logical_and.reduce(trues), np.logical_or.reduce(falses)
+            return np.logical_or.reduce(trues), np.logical_and.reduce(falses)
+        if op == "not":
+            true, false = visit(arg)
+            return false, true
+        column = get_column(arg)
+        null = np.asarray(pd.isnull(column), dtype=bool)
+        if op == "is_null":
+            return null, ~null
+        if op == "not_null":
+            return ~null, null
+        present = column[~null]
+        if op == "between":
+            low, high = next(values_iter), next(values_iter)
+            result = (present >= low) & (present <= high)
+        elif op == "in":
+            result = np.isin(present, next(values_iter))
+        else:
+            result = COMPARISONS[op](present, next(values_iter))
+        true = np.zeros(len(column), dtype=bool)
+        true[~null] = result
+        return true, ~true & ~null
+
+    return visit(shape)[0]
@@ -1,44 +1,113 @@
+"""Registry of algorithms.
+
+An algorithm is a module defining a `Master` and a `Worker` subclass. The
+built-in ones are listed here, others are discovered through the
+`mippy.algorithms` entry points, named after the algorithm and pointing to its
+module. Modules are imported only when one of their classes is needed, so a
+server or master loads the algorithms it runs and nothing else.
+"""
+import functools
+import importlib
+from importlib.metadata import entry_points
+from types import ModuleType
+from typing import Dict as DictType
+
 from addict import Dict
-from mippy.machinelearning.logistic_regression import *
-from mippy.machinelearning.pca import *
-from mippy.machinelearning.naive_bayes import *
-from mippy.machinelearning.linear_regression import *
-from mippy.machinelearning.kmeans import *
-from mippy.machinelearning.pearson import *
-from . import logistic_regression
-from . import pca
-from . import naive_bayes
-from . import linear_regression
-from . import kmeans
-from . import pearson
-
-from mippy.worker import Worker
-
-__all__ = []
-__all__.extend(logistic_regression.__all__)
-__all__.extend(pca.__all__)
-__all__.extend(naive_bayes.__all__)
-__all__.extend(linear_regression.__all__)
-__all__.extend(kmeans.__all__)
-__all__.extend(pearson.__all__)
-
-
-def get_reduction_rules():
+
+ENTRY_POINT_GROUP = "mippy.algorithms"
+
+builtin_algorithms = {
+    "logistic_regression": ["LogisticRegressionMaster", "LogisticRegressionWorker"],
+    "pca": ["PCAWorker", "PCAMaster"],
+    "naive_bayes": ["NaiveBayesWorker", "NaiveBayesMaster"],
+    "linear_regression": ["LinearRegressionMaster", "LinearRegressionWorker"],
+    "kmeans": ["KMeansMaster", "KMeansWorker"],
+    "pearson": ["PearsonWorker", "PearsonMaster"],
+}
+_origins = {name: algo for algo, names in builtin_algorithms.items() for name in names}
+
+__all__ = [
+    *_origins,
+    "reduction_rules",
+    "algorithms",
+    "load_algorithm",
+    "get_class",
+    "get_rules",
+]
+
+
+@functools.lru_cache(maxsize=None)
+def algorithms() -> DictType[str, str]:
+    """Module of every known algorithm, by name."""
+    modules = {name: f"{__name__}.{name}" for name in builtin_algorithms}
+    for entry_point in select_entry_points(ENTRY_POINT_GROUP):
+        modules.setdefault(entry_point.name, entry_point.value)
+    return modules
+
+
+def select_entry_points(group: str) -> list:
+    eps = entry_points()
+    if hasattr(eps, "select"):
+        return list(eps.select(group=group))
+    return list(eps.get(group, []))  # Python < 3.10
+
+
+def load_algorithm(name: str) -> ModuleType:
+    try:
+        module = algorithms()[name]
+    except KeyError:
+        raise ValueError(f"Unknown algorithm {name}.") from None
+    return importlib.import_module(module)
+
+
+@functools.lru_cache(maxsize=None)
+def get_class(kind: str) -> type:
+    """Master or worker class by name, importing only the module defining it."""
+    if kind in _origins:
+        return getattr(load_algorithm(_origins[kind]), kind)
+    for name in algorithms():
+        if name not in builtin_algorithms:
+            module = load_algorithm(name)
+            if kind in getattr(module, "__all__", ()):
+                return getattr(module, kind)
+    raise ValueError(f"Unknown worker or master {kind}.")
+
+
+@functools.lru_cache(maxsize=None)
+def get_rules(kind: str) -> Dict:
+    return worker_rules(get_class(kind))
+
+
+def worker_rules(worker_class: type) -> Dict:
+    """Reduction rules of the methods of a worker class, inherited ones too."""
     rules = Dict()
-    for worker_class in Worker.__subclasses__():
-        for name, attr in vars(worker_class).items():
-            try:
-                rules[worker_class.__name__][name] = attr.rules
-            except AttributeError:
-                pass
-        for name, attr in vars(Worker).items():
-            try:
-                rules[worker_class.__name__][name] = attr.rules
-            except AttributeError:
-                pass
+    for name in dir(worker_class):
+        try:
+            rules[name] = getattr(worker_class, name).rules
+        except AttributeError:
+            pass
     return rules
 
 
-reduction_rules = get_reduction_rules()
+def get_reduction_rules() -> Dict:
+    """Reduction rules of all workers, importing every algorithm."""
+    from mippy.worker import Worker
+
+    for name in algorithms():
+        load_algorithm(name)
+    return Dict({w.__name__: worker_rules(w) for w in Worker.__subclasses__()})
+
+
+def __getattr__(name: str):
+    if name in builtin_algorithms:
+        return load_algorithm(name)
+    if name in _origins:
+        return get_class(name)
+    if name == "reduction_rules":
+        globals()[name] = get_reduction_rules()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
-__all__.append("reduction_rules")
+def __dir__():
+    return sorted({*globals(), *builtin_algorithms, *__all__})
@@ -1,14 +1,21 @@
+import zlib
+from collections import namedtuple
+from typing import Iterator, Optional, Tuple
+
 import Pyro5.api
 import numpy as np
 from addict import Dict
-from mippy.worker import Worker
+from mippy.worker import Worker, cpu_bound
 from master import Master
 from mippy.parameters import get_parameters
 import mippy.reduce as reduce
 
 __all__ = ["KMeansMaster", "KMeansWorker"]
 
-from mippy.reduce import Mean
+MAX_ITER = 100
+TOL = 1e-6
+INIT_ROUNDS = 5
+DISTANCE_BLOCK = 2 ** 20  # entries of the distance matrix computed at a time
 
 properties = Dict(
     {
@@ -29,46 +36,234 @@ properties = Dict(
             "datasets": ["adni", "ppmi", "edsd"],
             "filter": None,
             "k": 2,
+            "max_iter": MAX_ITER,
+            "tol": TOL,
+            "batch_size": None,
+            "seed": 0,
         },
     }
 )
 
 
 class KMeansMaster(Master):
-    def run(self):
+    async def run_async(self):
         k = self.params.k
-        means = self.workers.init_means(k)
-        for _ in range(10):
-            means_new = self.workers.update_means(means)
-            means_new = [(means_new[i][0] / means_new[i][1]).tolist() for i in range(k)]
-            print(means_new)
-            if max_euclidean_distance(means, means_new) < 1e-6:
+        max_iter = self.params.get("max_iter") or MAX_ITER
+        tol = self.params.get("tol", TOL)
+        batch_size = self.params.get("batch_size")
+        seed = self.params.get("seed") or 0
+        means = await self.init_means(k, seed)
+        seen = np.zeros(k)
+        for iteration in range(max_iter):
+            if batch_size:
+                sums, counts = await self.workers.get_batch_sums(
+                    means, batch_size / self.n_obs, [seed, iteration]
+                )
+                # Per-center learning rate 1 / (points seen), Sculley (2010)
+                seen += counts
+                step = sums - counts[:, np.newaxis] * means
+                means_new = means + step / np.maximum(seen, 1)[:, np.newaxis]
+            else:
+                sums, counts = await self.workers.update_means(means)
+                means_new = means.copy()
+                nonempty = counts > 0
+                means_new[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+            print(means_new.tolist())
+            if max_euclidean_distance(means, means_new) < tol:
                 break
             means = means_new
         print("\nDone!")
 
+    async def init_means(self, k: int, seed: int) -> np.ndarray:
+        """k-means|| (Bahmani et al., 2012): sample about `oversampling` points
+        per round with probability proportional to their squared distance to
+        the current centers, weight the candidates by the number of points
+        closest to them and reduce them to k centers with k-means++."""
+        rng = np.random.default_rng(seed)
+        self.n_obs, (points, weights) = await self.workers.batch(
+            "get_num_obs", ("sample_points", [seed])
+        )
+        centers = points[[rng.choice(len(points), p=weights / weights.sum())]]
+        oversampling = self.params.get("oversampling") or 2 * k
+        for round_ in range(self.params.get("init_rounds") or INIT_ROUNDS):
+            cost = await self.workers.get_cost(centers)
+            if cost == 0:
+                break
+            candidates = await self.workers.sample_candidates(
+                centers, oversampling / cost, [seed, round_]
+            )
+            centers = np.concatenate([centers, candidates])
+        if len(centers) < k:
+            raise ValueError(f"Found {len(centers)} distinct points for k={k}.")
+        weights = await self.workers.get_candidate_weights(centers)
+        return weighted_kmeans_plus_plus(centers, weights, k, rng)
+
+
+Bounds = namedtuple("Bounds", "centers labels upper lower")
+
 
 class KMeansWorker(Worker):
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self._bounds: Optional[Bounds] = None
+
+    def memory_usage(self) -> int:
+        bounds = self._bounds
+        extra = sum(arr.nbytes for arr in bounds[1:]) if bounds is not None else 0
+        return super().memory_usage() + extra
+
+    def get_rng(self, seed: list) -> np.random.Generator:
+        # A different, reproducible stream on every server
+        return np.random.default_rng([*seed, zlib.crc32(self.name.encode())])
+
     @Pyro5.api.expose
-    @reduce.rules(None)
-    def init_means(self, k: int):
-        X = self.get_design_matrix(self.params.columns.features, intercept=False)
-        X = np.array(X)
-        return X[:k]
+    @reduce.rules("concat", "concat")
+    def sample_points(self, seed: list):
+        """One uniformly drawn point, weighted by the number of local points."""
+        X = self.get_design_array(self.params.columns.features, intercept=False)
+        if not len(X):
+            return X[:0], np.zeros(0)
+        return X[[self.get_rng(seed).integers(len(X))]], np.array([float(len(X))])
 
     @Pyro5.api.expose
-    @reduce.rules("mediants")
+    @cpu_bound
+    @reduce.rules("add")
+    def get_cost(self, centers) -> float:
+        X = self.get_design_array(self.params.columns.features, intercept=False)
+        _, dist = nearest_centers(X, np.asarray(centers))
+        return float(dist.sum())
+
+    @Pyro5.api.expose
+    @cpu_bound
+    @reduce.rules("concat")
+    def sample_candidates(self, centers, factor: float, seed: list):
+        X = self.get_design_array(self.params.columns.features, intercept=False)
+        _, dist = nearest_centers(X, np.asarray(centers))
+        return X[self.get_rng(seed).random(len(X)) < factor * dist]
+
+    @Pyro5.api.expose
+    @cpu_bound
+    @reduce.rules("add")
+    def get_candidate_weights(self, candidates):
+        X = self.get_design_array(self.params.columns.features, intercept=False)
+        labels, _ = nearest_centers(X, np.asarray(candidates))
+        return np.bincount(labels, minlength=len(candidates)).astype(float)
+
+    @Pyro5.api.expose
+    @cpu_bound
+    @reduce.rules("add", "add")
     def update_means(self, means):
-        k = len(means)
-        means = np.array(means)
-        X = self.get_design_matrix(self.params.columns.features, intercept=False)
-        X = np.array(X)
-        dist = np.linalg.norm(X - means[:, np.newaxis], axis=2)
-        cluster_idx = dist.argmin(axis=0)
-        sums = [X[cluster_idx == i].sum(axis=0) for i in range(k)]
-        counts = [len(X[cluster_idx == i]) for i in range(k)]
-        means = [Mean(s.tolist(), c) for s, c in zip(sums, counts)]
-        return means
+        means = np.asarray(means, dtype=float)
+        X = self.get_design_array(self.params.columns.features, intercept=False)
+        if self.params.get("pruning", True) and len(means) > 1:
+            labels = self.assign_with_bounds(X, means)
+        else:
+            labels, _ = nearest_centers(X, means)
+        return cluster_sums(X, labels, len(means))
+
+    @Pyro5.api.expose
+    @cpu_bound
+    @reduce.rules("add", "add")
+    def get_batch_sums(self, means, fraction: float, seed: list):
+        means = np.asarray(means, dtype=float)
+        X = self.get_design_array(self.params.columns.features, intercept=False)
+        rng = self.get_rng(seed)
+        size = rng.binomial(len(X), min(fraction, 1.0))
+        X = X[np.sort(rng.choice(len(X), size=size, replace=False))]
+        labels, _ = nearest_centers(X, means)
+        return cluster_sums(X, labels, len(means))
+
+    def assign_with_bounds(self, X: np.ndarray, centers: np.ndarray) -> np.ndarray:
+        """Nearest centers with Hamerly's (2010) bounds, kept from the previous
+        call, so that only points whose bounds overlap are compared with all
+        centers."""
+        bounds = self._bounds
+        if bounds is None or bounds.centers.shape != centers.shape:
+            labels, upper, lower = two_nearest_centers(X, centers)
+        else:
+            drift = np.sqrt(((centers - bounds.centers) ** 2).sum(axis=1))
+            labels = bounds.labels.copy()
+            upper = bounds.upper + drift[labels]
+            lower = bounds.lower - drift.max()
+            gaps = np.sqrt(squared_distances(centers, centers))
+            np.fill_diagonal(gaps, np.inf)
+            threshold = np.maximum(gaps.min(axis=1)[labels] / 2, lower)
+            idx = np.flatnonzero(upper > threshold)
+            upper[idx] = np.sqrt(((X[idx] - centers[labels[idx]]) ** 2).sum(axis=1))
+            idx = idx[upper[idx] > threshold[idx]]
+            labels[idx], upper[idx], lower[idx] = two_nearest_centers(X[idx], centers)
+        self._bounds = Bounds(centers, labels, upper, lower)
+        return labels
+
+
+def squared_distances(X: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, one matrix product instead of a
+    # n x k x p difference tensor
+    dist = X @ centers.T
+    dist *= -2
+    dist += np.einsum("ij,ij->i", X, X)[:, np.newaxis]
+    dist += np.einsum("ij,ij->i", centers, centers)
+    return np.maximum(dist, 0, out=dist)
+
+
+def row_blocks(n_rows: int, n_centers: int) -> Iterator[slice]:
+    """Row blocks small enough to keep their distance matrix under
+    DISTANCE_BLOCK entries."""
+    step = max(DISTANCE_BLOCK // max(n_centers, 1), 1)
+    for start in range(0, n_rows, step):
+        yield slice(start, start + step)
+
+
+def nearest_centers(
+    X: np.ndarray, centers: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Index of and squared distance to the nearest center of every row."""
+    labels = np.empty(len(X), dtype=np.intp)
+    dist = np.empty(len(X))
+    for rows in row_blocks(len(X), len(centers)):
+        block = squared_distances(X[rows], centers)
+        labels[rows] = block.argmin(axis=1)
+        dist[rows] = block[np.arange(len(block)), labels[rows]]
+    return labels, dist
+
+
+def two_nearest_centers(
+    X: np.ndarray, centers: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Nearest center and the distances to the nearest and second nearest."""
+    labels = np.empty(len(X), dtype=np.intp)
+    first, second = np.empty(len(X)), np.empty(len(X))
+    for rows in row_blocks(len(X), len(centers)):
+        block = squared_distances(X[rows], centers)
+        labels[rows] = block.argmin(axis=1)
+        smallest = np.partition(block, 1, axis=1)
+        first[rows], second[rows] = smallest[:, 0], smallest[:, 1]
+    return labels, np.sqrt(first), np.sqrt(second)
+
+
+def cluster_sums(
+    X: np.ndarray, labels: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    sums = np.zeros((k, X.shape[1]))
+    np.add.at(sums, labels, X)
+    return sums, np.bincount(labels, minlength=k)
+
+
+def weighted_kmeans_plus_plus(
+    points: np.ndarray, weights: np.ndarray, k: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Pick k of the points, each with probability proportional to its weight
+    times its squared distance to the points already picked."""
+    chosen = [rng.choice(len(points), p=weights / weights.sum())]
+    dist = squared_distances(points, points[chosen]).ravel()
+    for _ in range(1, k):
+        prob = weights * dist
+        if prob.sum() > 0:
+            chosen.append(rng.choice(len(points), p=prob / prob.sum()))
+        else:
+            chosen.append(rng.choice(np.setdiff1d(np.arange(len(points)), chosen)))
+        dist = np.minimum(dist, squared_distances(points, points[chosen[-1:]]).ravel())
+    return points[chosen]
 
 
 def max_euclidean_distance(x, y):
@@ -81,6 +276,7 @@ if __name__ == "__main__":
     import time
 
     s = time.perf_counter()
-    KMeansMaster(parameters).run()
+    with KMeansMaster(parameters) as master:
+        master.run()
     elapsed = time.perf_counter() - s
     print(f"\nExecuted in {elapsed:0.3f} seconds.")
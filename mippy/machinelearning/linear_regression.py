@@ -1,12 +1,11 @@
-from typing import Tuple
-
 import Pyro5.api
 import numpy as np
 from addict import Dict
 
-from mippy.worker import Worker
+from mippy.solvers import solve_from_r, solve_spd
+from mippy.worker import Worker, cpu_bound
 from master import Master
-from mippy.parameters import get_parameters
+from mippy.parameters import get_columns, get_models, get_parameters
 import mippy.reduce as reduce
 
 __all__ = ["LinearRegressionMaster", "LinearRegressionWorker"]
@@ -33,31 +32,61 @@ properties = Dict(
             },
             "datasets": ["adni", "ppmi", "edsd"],
             "filter": None,
+            "models": None,
+            "solver": None,  # "tsqr" to solve from R factors instead of Gramians
         },
     }
 )
 
 
 class LinearRegressionMaster(Master):
-    def run(self):
-        gramian, moment_matrix = self.workers.get_gramian_and_moment_matrix()
-        covariance = np.linalg.inv(gramian)
-        coeff = covariance @ moment_matrix
+    """Fits every model of the `models` parameter from a single Gramian of all
+    their columns, the rows used are those complete in all of them."""
+
+    async def run_async(self):
+        columns = get_columns(self.params)
+        models = get_models(self.params)
+        tsqr = self.params.get("solver") == "tsqr"
+        if tsqr:
+            R = await self.workers.get_r_factor()
+        else:
+            gramian = await self.workers.get_gramian()
         print("Done!\n")
-        print(f"model coefficients = \n{coeff}")
+        for model in models:
+            # Intercept and features, X.T @ X and X.T @ y are blocks of the Gramian
+            features = [0] + [columns.index(col) + 1 for col in model.features]
+            target = [columns.index(col) + 1 for col in model.target]
+            if tsqr:
+                coeff = solve_from_r(R, features, target)
+            else:
+                coeff = solve_spd(
+                    gramian[np.ix_(features, features)],
+                    gramian[np.ix_(features, target)],
+                )
+            if len(models) > 1:
+                print(f"{model.target} ~ {model.features}")
+            print(f"model coefficients = \n{coeff}")
 
 
 class LinearRegressionWorker(Worker):
     @Pyro5.api.expose
-    @reduce.rules("add", "add")
-    def get_gramian_and_moment_matrix(self) -> Tuple[list, list]:
-        X = self.get_design_matrix(self.params.columns.features)
-        y = self.get_design_matrix(self.params.columns.target, intercept=False)
-        X, y = np.array(X), np.array(y)
+    @reduce.rules("add")
+    def get_gramian(self) -> np.ndarray:
+        """Gramian of the intercept and all the requested columns."""
+        return self.get_moments().gramian
 
-        gramian = X.T @ X
-        moment_matrix = X.T @ y
-        return gramian, moment_matrix
+    @Pyro5.api.expose
+    @cpu_bound
+    @reduce.rules("tsqr")
+    def get_r_factor(self) -> np.ndarray:
+        """R factor of the QR decomposition of the intercept and all the
+        requested columns, the Gramian being R.T @ R."""
+        columns = get_columns(self.params)
+        R = np.zeros((0, len(columns) + 1))
+        for chunk in self.iter_chunks():
+            Z = chunk.get_design_array(columns)
+            R = reduce.stack_r(R, np.linalg.qr(Z, mode="r"))
+        return R
 
 
 if __name__ == "__main__":
@@ -66,6 +95,7 @@ if __name__ == "__main__":
     import time
 
     s = time.perf_counter()
-    LinearRegressionMaster(parameters).run()
+    with LinearRegressionMaster(parameters) as master:
+        master.run()
     elapsed = time.perf_counter() - s
     print(f"\nExecuted in {elapsed:0.3f} seconds.")
@@ -1,16 +1,19 @@
-from typing import Tuple
+from typing import List, Tuple
 
 import Pyro5.api
 import numpy as np
 from scipy.special import expit, xlogy
 from addict import Dict
-from mippy.worker import Worker
+from mippy.solvers import solve_spd
+from mippy.worker import Worker, cpu_bound
 from master import Master
-from mippy.parameters import get_parameters
+from mippy.parameters import get_models, get_parameters
 import mippy.reduce as reduce
 
 __all__ = ["LogisticRegressionMaster", "LogisticRegressionWorker"]
 
+MAX_CELLS = 2 ** 22  # rows times models evaluated at once
+
 properties = Dict(
     {
         "name": "logistic regression",
@@ -30,68 +33,117 @@ properties = Dict(
             "datasets": ["adni"],
             "filter": {"alzheimerbroadcategory": ["CN", "AD"]},
             "outcome": "AD",
+            "models": None,
         },
     }
 )
 
 
 class LogisticRegressionMaster(Master):
-    def run(self):
-        n_feat = self.workers.get_num_features()
-        n_obs = self.workers.get_num_obs()
-        coeff, loglike = self.init_model(n_feat, n_obs)
-        while True:
-            print(f"loss: {-loglike}")
-            loglike_new, grad, hess = self.workers.get_loss_function(coeff)
-            coeff = self.update_coefficients(grad, hess)
-            if abs((loglike - loglike_new) / loglike) <= 1e-6:
-                break
-            loglike = loglike_new
+    """Fits every model of the `models` parameter at once, each Newton step
+    evaluating all the models not converged yet in one call to the servers.
+    The rows used are those complete in the columns of all models."""
+
+    async def run_async(self):
+        models = get_models(self.params)
+        columns = design_columns(models)
+        n_obs = await self.workers.get_num_obs()
+        coeffs, loglikes = self.init_models(len(models), len(columns), n_obs)
+        active = list(range(len(models)))
+        while active:
+            losses = -loglikes[active]
+            print(f"loss: {losses[0] if len(models) == 1 else losses}")
+            loglikes_new, grads, hessians = await self.workers.get_loss_functions(
+                coeffs[active], active
+            )
+            converging = []
+            for i, m in enumerate(active):
+                idx = model_columns(models[m], columns)
+                coeffs[m, idx] = self.update_coefficients(
+                    grads[i, idx], hessians[i][np.ix_(idx, idx)]
+                )
+                if abs((loglikes[m] - loglikes_new[i]) / loglikes[m]) > 1e-6:
+                    loglikes[m] = loglikes_new[i]
+                    converging.append(m)
+            active = converging
         print("\nDone!\n")
-        print(f"loss = {-loglike}\n")
-        print(f"model coefficients = \n{coeff}\n")
+        for model, coeff, loglike in zip(models, coeffs, loglikes):
+            if len(models) > 1:
+                print(f"{model.target} ~ {model.features}")
+            print(f"loss = {-loglike}\n")
+            print(f"model coefficients = \n{coeff[model_columns(model, columns)]}\n")
 
     @staticmethod
-    def init_model(n_feat: int, n_obs: int) -> Tuple[np.ndarray, float]:
-        ll = -2 * n_obs * np.log(2)
-        coeff = np.zeros(n_feat + 1)
-        return coeff, ll
+    def init_models(
+        n_models: int, n_feat: int, n_obs: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        ll = np.full(n_models, -2 * n_obs * np.log(2))
+        coeffs = np.zeros((n_models, n_feat + 1))
+        return coeffs, ll
 
     @staticmethod
     def update_coefficients(grad: np.ndarray, hess: np.ndarray) -> np.ndarray:
-        covariance = np.linalg.inv(hess)
-        coeff = covariance @ grad
-        return coeff
+        return solve_spd(hess, grad)
 
 
 class LogisticRegressionWorker(Worker):
     @Pyro5.api.expose
-    @reduce.rules(None)
-    def get_num_features(self) -> int:
-        return len(self.params["columns"]["features"])
-
-    @Pyro5.api.expose
+    @cpu_bound
     @reduce.rules("add", "add", "add")
-    def get_loss_function(self, coeff: list) -> Tuple[float, list, list]:
-        coeff = np.array(coeff)
-        X = self.get_design_matrix(self.params.columns.features)
-        y = self.get_target_column(self.params.columns.target, self.params.outcome)
-        X, y = np.array(X), np.array(y)
+    def get_loss_functions(
+        self, coeffs: list, active: list
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Log-likelihoods, gradients and Hessians of the `active` models in one
+        pass over the rows. Coefficients, gradients and Hessians span all the
+        design columns, zero outside of each model's own."""
+        all_models = get_models(self.params)
+        models = [all_models[m] for m in active]
+        columns = design_columns(all_models)
+        coeffs = np.array(coeffs)  # a row per model
+        X = self.get_design_array(columns)
+        Y = np.stack(
+            [
+                self.get_target_array(model.target, self.params.outcome)
+                for model in models
+            ]
+        )
+
+        # Weighted products instead of X.T @ diag(d) @ X keep memory O(n*p + p^2)
+        loglike = np.zeros(len(models))
+        grad = np.zeros(coeffs.shape)
+        hess = np.zeros((len(models), X.shape[1], X.shape[1]))
+        for rows in self.iter_row_slices(len(X), max_rows=MAX_CELLS // len(models)):
+            X_chunk, Y_chunk = X[rows], Y[:, rows]
+            Z = coeffs @ X_chunk.T
+            S = expit(Z)
+            D = S * (1 - S)
+
+            for i, model in enumerate(models):
+                idx = model_columns(model, columns)
+                X_model = X_chunk[:, idx]
+                hess[i][np.ix_(idx, idx)] += (X_model.T * D[i]) @ X_model
+            Y_ratio = (Y_chunk - S) / D
+            Y_ratio[(Y_chunk == 0) & (S == 0)] = -1
+            Y_ratio[(Y_chunk == 1) & (S == 1)] = 1
+
+            grad += (D * (Z + Y_ratio)) @ X_chunk
+
+            loglike += np.sum(xlogy(Y_chunk, S) + xlogy(1 - Y_chunk, 1 - S), axis=1)
+        own = np.zeros(grad.shape, dtype=bool)
+        for i, model in enumerate(models):
+            own[i, model_columns(model, columns)] = True
+        grad[~own] = 0
+        return loglike, grad, hess
 
-        z = X @ coeff
-        s = expit(z)
-        d = s * (1 - s)
-        D = np.diag(d)
 
-        hess = X.T @ D @ X
-        y_ratio = (y - s) / d
-        y_ratio[(y == 0) & (s == 0)] = -1
-        y_ratio[(y == 1) & (s == 1)] = 1
+def design_columns(models: List[Dict]) -> List[str]:
+    """Features of all models, the columns of the design matrix after the
+    intercept."""
+    return list(dict.fromkeys(col for model in models for col in model.features))
 
-        grad = X.T @ D @ (z + y_ratio)
 
-        loglike = float(np.sum(xlogy(y, s) + xlogy(1 - y, 1 - s)))
-        return loglike, grad, hess
+def model_columns(model: Dict, columns: List[str]) -> List[int]:
+    return [0] + [columns.index(col) + 1 for col in model.features]
 
 
 if __name__ == "__main__":
@@ -100,6 +152,7 @@ if __name__ == "__main__":
     import time
 
     s = time.perf_counter()
-    LogisticRegressionMaster(parameters).run()
+    with LogisticRegressionMaster(parameters) as master:
+        master.run()
     elapsed = time.perf_counter() - s
     print(f"\nExecuted in {elapsed:0.3f} seconds.")
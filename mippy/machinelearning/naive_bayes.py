@@ -1,8 +1,10 @@
 import Pyro5.api
+import numpy as np
+import pandas as pd
 from addict import Dict
 import pprint
 
-from mippy.worker import Worker
+from mippy.worker import Worker, cpu_bound
 from master import Master
 from mippy.parameters import get_parameters
 import mippy.reduce as reduce
@@ -22,7 +24,12 @@ properties = Dict(
                 "features": {
                     "names": ["gender"],
                     "required": True,
-                    "types": ["categorical"],  # for now only multinomial naive bayes
+                    "types": ["categorical"],
+                },
+                "numerical": {
+                    "names": [],
+                    "required": False,
+                    "types": ["numerical"],  # Gaussian naive bayes
                 },
             },
             "alpha": {"value": 0.5, "required": True, "types": ["float"]},
@@ -34,45 +41,90 @@ properties = Dict(
 
 
 class NaiveBayesMaster(Master):
-    def run(self):
+    async def run_async(self):
         alpha = self.params.alpha.value
-        target_counts, pair_counts = self.workers.get_counts()
-        n_obs = sum(count for count in target_counts.values())
-        theta = {}
-        for key, count in pair_counts.items():
-            target_count = target_counts[key[0]]
-            parameter = (count + alpha) / (target_count + n_obs * alpha)
-            theta[key] = parameter
+        target = self.params.columns.target[0]
+        features = self.params.columns.features
+        numerical = self.params.columns.get("numerical") or []
+        categories = await self.workers.get_categories()
+        class_counts, counts, sums, squares = await self.workers.get_counts(categories)
+        n_obs = class_counts.sum()
+        probabilities = (counts + alpha) / (class_counts[:, np.newaxis] + n_obs * alpha)
+        classes = [f"{target}: {value}" for value in categories[target]]
+        values = [
+            f"{feature}: {value}"
+            for feature in features
+            for value in categories[feature]
+        ]
+        theta = {
+            (cls, value): float(probabilities[i, j])
+            for i, cls in enumerate(classes)
+            for j, value in enumerate(values)
+        }
 
         pp = pprint.PrettyPrinter(indent=4)
         print("\nDone!\n")
         print("model parameres = \n")
         pp.pprint(theta)
+        if numerical:
+            means = sums / class_counts[:, np.newaxis]
+            variances = squares / class_counts[:, np.newaxis] - means ** 2
+            print(f"\nclasses = {classes}\n")
+            print(f"means of {numerical} = \n{means}\n")
+            print(f"variances of {numerical} = \n{variances}\n")
 
 
 class NaiveBayesWorker(Worker):
     @Pyro5.api.expose
-    @reduce.rules("add_dict", "add_dict")
-    def get_counts(self):
-        X = self.get_design_matrix(
-            self.params.columns.features + self.params.columns.target, intercept=False
-        )
+    @reduce.rules("union_dict")
+    def get_categories(self):
+        """Values of the target and of the categorical features, the master
+        sends their union back so that all servers count on the same codes."""
+        columns = self.params.columns.target + self.params.columns.features
+        values = {column: set() for column in columns}
+        for chunk in self.iter_chunks():
+            for column in columns:
+                values[column].update(chunk.data[column].unique().tolist())
+        return {
+            column: sorted(column_values) for column, column_values in values.items()
+        }
+
+    @Pyro5.api.expose
+    @cpu_bound
+    @reduce.rules("add", "add", "add", "add")
+    def get_counts(self, categories):
+        """Rows per class, counts per class of the values of the categorical
+        features, side by side in one array, and per class sums and sums of
+        squares of the numerical features for Gaussian naive Bayes."""
         target = self.params.columns.target[0]
+        features = self.params.columns.features
+        numerical = self.params.columns.get("numerical") or []
+        n_classes = len(categories[target])
+        offsets = np.cumsum([0] + [len(categories[feature]) for feature in features])
+        class_counts = np.zeros(n_classes, dtype=np.int64)
+        counts = np.zeros((n_classes, offsets[-1]), dtype=np.int64)
+        sums = np.zeros((n_classes, len(numerical)))
+        squares = np.zeros((n_classes, len(numerical)))
+        for chunk in self.iter_chunks():
+            classes = category_codes(chunk.data[target], categories[target])
+            class_counts += np.bincount(classes, minlength=n_classes)
+            for feature, start, stop in zip(features, offsets, offsets[1:]):
+                n_values = stop - start
+                cells = classes * n_values
+                cells += category_codes(chunk.data[feature], categories[feature])
+                cell_counts = np.bincount(cells, minlength=n_classes * n_values)
+                counts[:, start:stop] += cell_counts.reshape(n_classes, n_values)
+            if numerical:
+                X = chunk.get_design_array(numerical, intercept=False)
+                indicators = np.zeros((len(classes), n_classes))
+                indicators[np.arange(len(classes)), classes] = 1
+                sums += indicators.T @ X
+                squares += indicators.T @ (X * X)
+        return class_counts, counts, sums, squares
 
-        target_counts = {}
-        for group in X.groupby(target):
-            key = target + ": " + group[0]
-            count = len(group[1])
-            target_counts[key] = count
 
-        pair_counts = {}
-        for feature in self.params.columns.features:
-            for group in X.groupby(target):
-                for subgroup in group[1].groupby(feature):
-                    key = (target + ": " + group[0], feature + ": " + subgroup[0])
-                    count = len(subgroup[1])
-                    pair_counts[key] = count
-        return target_counts, pair_counts
+def category_codes(values: pd.Series, categories: list) -> np.ndarray:
+    return pd.Categorical(values, categories=categories).codes.astype(np.intp)
 
 
 if __name__ == "__main__":
@@ -81,6 +133,7 @@ if __name__ == "__main__":
     import time
 
     s = time.perf_counter()
-    NaiveBayesMaster(parameters).run()
+    with NaiveBayesMaster(parameters) as master:
+        master.run()
     elapsed = time.perf_counter() - s
     print(f"\nExecuted in {elapsed:0.3f} seconds.")
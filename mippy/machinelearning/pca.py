@@ -1,13 +1,16 @@
 import Pyro5.api
 import numpy as np
 from addict import Dict
-from mippy.worker import Worker
+from mippy.worker import Worker, cpu_bound
 from master import Master
 from mippy.parameters import get_parameters
 import mippy.reduce as reduce
 
 __all__ = ["PCAWorker", "PCAMaster"]
 
+OVERSAMPLING = 10
+N_ITER = 4
+
 properties = Dict(
     {
         "name": "pca",
@@ -26,19 +29,26 @@ properties = Dict(
             },
             "datasets": ["adni", "ppmi", "edsd"],
             "filter": None,
+            "n_components": None,  # top components only, by randomized iteration
+            "oversampling": OVERSAMPLING,
+            "n_iter": N_ITER,
+            "seed": 0,
         },
     }
 )
 
 
 class PCAMaster(Master):
-    def run(self):
-        n_obs = self.workers.get_num_obs()
-        sx, sxx = self.workers.get_local_sums()
+    async def run_async(self):
+        n_obs, sx, sxx = await self.workers.get_local_sums()
         means, sigmas = self.get_moments(n_obs, sx, sxx)
-        gramian = self.workers.get_standardized_gramian(means, sigmas)
-        covariance = np.divide(gramian, n_obs - 1)
-        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        if self.params.get("n_components"):
+            eigenvalues, eigenvectors = await self.randomized_eigh(means, sigmas)
+            eigenvalues /= n_obs - 1
+        else:
+            gramian = await self.workers.get_standardized_gramian(means, sigmas)
+            covariance = np.divide(gramian, n_obs - 1)
+            eigenvalues, eigenvectors = np.linalg.eigh(covariance)
         idx = eigenvalues.argsort()[::-1]
         eigenvalues = eigenvalues[idx]
         eigenvectors = eigenvectors[:, idx]
@@ -47,6 +57,24 @@ class PCAMaster(Master):
         print(f"eigenvalues = \n{eigenvalues}\n")
         print(f"eigenvectors = \n{eigenvectors}\n")
 
+    async def randomized_eigh(self, means, sigmas):
+        """Top `n_components` eigenpairs of the standardized Gramian by
+        randomized subspace iteration (Halko et al., 2011), a p x l basis going
+        to the servers and its product with their Gramians coming back every
+        round, l being `n_components` plus `oversampling`, instead of p x p
+        Gramians. `n_iter` rounds of power iteration refine the basis, enough
+        when the spectrum decays, the final round projects the Gramian on it."""
+        k = self.params.n_components
+        size = min(k + (self.params.get("oversampling") or 0), len(means))
+        rng = np.random.default_rng(self.params.get("seed") or 0)
+        basis, _ = np.linalg.qr(rng.standard_normal((len(means), size)))
+        for _ in range(self.params.get("n_iter", N_ITER) + 1):
+            product = await self.workers.get_standardized_product(means, sigmas, basis)
+            basis, _ = np.linalg.qr(product)
+        product = await self.workers.get_standardized_product(means, sigmas, basis)
+        eigenvalues, eigenvectors = np.linalg.eigh(basis.T @ product)
+        return eigenvalues[-k:], basis @ eigenvectors[:, -k:]
+
     @staticmethod
     def get_moments(n_obs, sx, sxx):
         means = sx / n_obs
@@ -56,27 +84,52 @@ class PCAMaster(Master):
 
 class PCAWorker(Worker):
     @Pyro5.api.expose
-    @reduce.rules("add", "add")
+    @reduce.rules("add", "add", "add")
     def get_local_sums(self):
-        X = self.get_design_matrix(self.params.columns.variables, intercept=False)
-        X = np.array(X)
-        sx = X.sum(axis=0)
-        sxx = (X ** 2).sum(axis=0)
-        return sx, sxx
+        columns = self.params.columns.variables
+        if not self.params.get("n_components"):
+            moments = self.get_moments().select(columns)
+            return moments.n_obs, moments.sums, np.diag(moments.cross_products)
+        # no cross products, p x p of them would cost more than the iterations
+        n_obs, sx, sxx = 0, np.zeros(len(columns)), np.zeros(len(columns))
+        for chunk in self.iter_chunks():
+            X = chunk.get_design_array(columns, intercept=False)
+            n_obs += len(X)
+            sx += X.sum(axis=0)
+            sxx += np.einsum("ij,ij->j", X, X)
+        return n_obs, sx, sxx
 
     @Pyro5.api.expose
     @reduce.rules("add")
     def get_standardized_gramian(self, means, sigmas):
         means = np.array(means)
         sigmas = np.array(sigmas)
-        X = self.get_design_matrix(self.params.columns.variables, intercept=False)
-        X = np.array(X)
-        if X.shape == (0, 0):
-            return 0
-        X -= means
-        X /= sigmas
-        gramian = np.dot(X.T, X)
-        return gramian
+        moments = self.get_moments().select(self.params.columns.variables)
+        n_obs, sx = moments.n_obs, moments.sums
+        # sum (x - m)(x - m)' expanded, from the raw moments
+        gramian = (
+            moments.cross_products
+            - np.outer(sx, means)
+            - np.outer(means, sx)
+            + n_obs * np.outer(means, means)
+        )
+        return gramian / np.outer(sigmas, sigmas)
+
+    @Pyro5.api.expose
+    @cpu_bound
+    @reduce.rules("add")
+    def get_standardized_product(self, means, sigmas, basis):
+        """Z.T @ Z @ basis for the standardized data Z, without forming Z."""
+        means = np.array(means)
+        sigmas = np.array(sigmas)
+        scaled = np.array(basis) / sigmas[:, np.newaxis]
+        columns = self.params.columns.variables
+        product = np.zeros(scaled.shape)
+        for chunk in self.iter_chunks():
+            X = chunk.get_design_array(columns, intercept=False)
+            projection = X @ scaled - means @ scaled  # Z @ basis
+            product += X.T @ projection - np.outer(means, projection.sum(axis=0))
+        return product / sigmas[:, np.newaxis]
 
 
 if __name__ == "__main__":
@@ -85,6 +138,7 @@ if __name__ == "__main__":
     import time
 
     s = time.perf_counter()
-    PCAMaster(parameters).run()
+    with PCAMaster(parameters) as master:
+        master.run()
     elapsed = time.perf_counter() - s
     print(f"\nExecuted in {elapsed:0.3f} seconds.")
@@ -3,7 +3,8 @@ import numpy as np
 from addict import Dict
 from scipy import special
 
-from mippy.worker import Worker
+from mippy.stats import cross_products
+from mippy.worker import BLOCK_SIZE, Worker
 from master import Master
 from mippy.parameters import get_parameters
 import mippy.reduce as reduce
@@ -25,6 +26,11 @@ properties = Dict(
                     "required": True,
                     "types": ["numerical"],
                 },
+                "covariables": {
+                    "names": [],
+                    "required": False,
+                    "types": ["numerical"],
+                },
             },
             "datasets": ["adni", "ppmi", "edsd"],
             "filter": None,
@@ -34,9 +40,8 @@ properties = Dict(
 
 
 class PearsonMaster(Master):
-    def run(self):
-        n_obs = self.workers.get_num_obs()
-        sx, sxx, sxy, sy, syy = self.workers.get_local_sums()
+    async def run_async(self):
+        n_obs, sx, sxx, sxy, sy, syy = await self.workers.get_local_sums()
         df = n_obs - 2
         d = (
             np.sqrt(n_obs * sxx - sx * sx)
@@ -57,16 +62,29 @@ class PearsonMaster(Master):
 
 class PearsonWorker(Worker):
     @Pyro5.api.expose
-    @reduce.rules("add", "add", "add", "add", "add")
+    @reduce.rules("add", "add", "add", "add", "add", "add")
     def get_local_sums(self):
-        X = self.get_design_matrix(self.params.columns.variables, intercept=False)
-        Y = X = np.array(X)
-        sx = X.sum(axis=0)
-        sy = Y.sum(axis=0)
-        sxx = (X ** 2).sum(axis=0)
-        sxy = (X * Y.T[:, :, np.newaxis]).sum(axis=1)
-        syy = (Y ** 2).sum(axis=0)
-        return sx, sxx, sxy, sy, syy
+        variables = self.params.columns.variables
+        covariables = self.params.columns.get("covariables")
+        if not covariables:  # all the pairs, from the statistics cache if there
+            moments = self.get_moments().select(variables)
+            sx, sxx = moments.sums, np.diag(moments.cross_products)
+            return moments.n_obs, sx, sxx, moments.cross_products, sx, sxx
+        # variables against covariables only, not the Gramian of their union
+        n_obs, sx, sxx = 0, np.zeros(len(variables)), np.zeros(len(variables))
+        sy, syy = np.zeros(len(covariables)), np.zeros(len(covariables))
+        sxy = np.zeros((len(covariables), len(variables)))
+        block_size = self.params.get("block_size") or BLOCK_SIZE
+        for chunk in self.iter_chunks():
+            X = chunk.get_design_array(variables, intercept=False)
+            Y = chunk.get_design_array(covariables, intercept=False)
+            n_obs += len(X)
+            sx += X.sum(axis=0)
+            sxx += np.einsum("ij,ij->j", X, X)
+            sy += Y.sum(axis=0)
+            syy += np.einsum("ij,ij->j", Y, Y)
+            sxy += cross_products(Y, X, block_size)
+        return n_obs, sx, sxx, sxy, sy, syy
 
 
 if __name__ == "__main__":
@@ -75,6 +93,7 @@ if __name__ == "__main__":
     import time
 
     s = time.perf_counter()
-    PearsonMaster(parameters).run()
+    with PearsonMaster(parameters) as master:
+        master.run()
     elapsed = time.perf_counter() - s
     print(f"\nExecuted in {elapsed:0.3f} seconds.")
@@ -1,25 +1,94 @@
-from abc import ABC, abstractmethod
+import asyncio
+from abc import ABC
+from typing import List, Mapping, Optional
 
 from addict import Dict
 
-from mippy import WorkerPool
+from mippy import AsyncWorkerPool, WorkerPool, run_sync
 
 server_names = ["serverA", "serverB", "serverC"]
 
 
 class Master(ABC):
-    def __init__(self, params: Dict) -> None:
-        global server_names  # todo this should be a parameter
+    """Runs an algorithm over the servers, either blocking
+
+        with PCAMaster(params) as master:
+            master.run()
+
+    or on an event loop, where many runs can go on concurrently
+
+        async with PCAMaster(params, timeout=60) as master:
+            await master.run_async()
+
+    Options of the `AsyncWorkerPool` bound the rounds (`timeout`), the whole
+    run (`deadline`) and every call to a server (`call_timeout`, `retries`).
+    `replicas` maps servers to others holding the same data, called when a
+    server has not answered after `hedge_after` seconds.
+
+    Algorithms implement `async def run_async`, awaiting the rounds of
+    `self.workers`. Those implementing a blocking `run` instead get a blocking
+    `WorkerPool` and run in a thread when awaited.
+    """
+
+    def __init__(
+        self,
+        params: Dict,
+        servers: Optional[List[str]] = None,
+        replicas: Optional[Mapping[str, List[str]]] = None,
+        **options,
+    ) -> None:
+        replicas = replicas or {}
+        replica_names = {name for names in replicas.values() for name in names}
+        servers = servers or [
+            name for name in server_names if name not in replica_names
+        ]
         cls = type(self).__name__
-        self.workers = WorkerPool(
-            [f"local-server.{name}" for name in server_names], params, master=cls
+        self.pool = AsyncWorkerPool(
+            [f"local-server.{name}" for name in servers],
+            params,
+            master=cls,
+            replicas={
+                f"local-server.{name}": [f"local-server.{r}" for r in names]
+                for name, names in replicas.items()
+            },
+            **options,
         )
+        blocking = type(self).run is not Master.run
+        self.workers = WorkerPool.wrap(self.pool) if blocking else self.pool
         self.params = params
 
     def __repr__(self) -> str:
         cls = type(self).__name__
         return f"{cls}({self.params})"
 
-    @abstractmethod
+    def __enter__(self) -> "Master":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    async def __aenter__(self) -> "Master":
+        await self.pool.open()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close_async()
+
     def run(self) -> None:
-        """Main execution of algorithm. Should be implemented in child classes."""
+        run_sync(self.run_async())
+
+    def close(self) -> None:
+        """Release the data held by the servers for this run."""
+        run_sync(self.close_async())
+
+    async def close_async(self) -> None:
+        await self.pool.close()
+
+    async def run_async(self) -> None:
+        """Main execution of algorithm. Should be implemented in child classes,
+        or `run`."""
+        if type(self).run is Master.run:
+            raise NotImplementedError(
+                f"{type(self).__name__} must implement run_async or run."
+            )
+        await asyncio.get_running_loop().run_in_executor(None, self.run)
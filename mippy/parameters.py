@@ -1,9 +1,11 @@
 import argparse
+import json
 import sys
+from typing import Any, List
 
 from addict import Dict
 
-__all__ = ["get_parameters"]
+__all__ = ["get_parameters", "get_columns", "get_models"]
 
 
 def get_parameters(properties: Dict) -> Dict:
@@ -17,13 +19,40 @@ def get_parameters(properties: Dict) -> Dict:
     for name, param in properties.parameters.items():
         if name == "columns":
             continue
-        if getattr(args, name):
+        if name in ("filter", "models") and getattr(args, name):
+            parameters[name] = json.loads(getattr(args, name))
+        elif isinstance(param, list) and getattr(args, name):
             parameters[name] = getattr(args, name).split(",")
+        elif getattr(args, name):
+            parameters[name] = _parse_scalar(getattr(args, name))
         else:
             parameters[name] = param
     return parameters
 
 
+def get_columns(parameters: Dict) -> List[str]:
+    columns: List[str] = [
+        column
+        for model in get_models(parameters)
+        for cols in model.values()
+        for column in cols
+    ]
+    return list(dict.fromkeys(columns))  # groups may share columns
+
+
+def get_models(parameters: Dict) -> List[Dict]:
+    """Column groups of every model fitted in a batch, the `models` parameter
+    is a list of such groups, each like `columns`, which it replaces."""
+    return [Dict(model) for model in parameters.get("models") or [parameters.columns]]
+
+
+def _parse_scalar(value: str) -> Any:
+    try:
+        return json.loads(value)  # numbers, true, false and null
+    except ValueError:
+        return value
+
+
 def _parse_args(params: Dict) -> argparse.Namespace:
     parser = argparse.ArgumentParser()
     for column in params.columns.keys():
@@ -0,0 +1,183 @@
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Collection, List, Mapping, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+__all__ = ["ComputePool", "SharedFrame", "attach_frame"]
+
+PROCESS_CACHE_SIZE = 4  # workers kept in every process
+
+
+class SharedFrame:
+    """Copy of a DataFrame in shared memory, one block per column, which the
+    pool processes attach to instead of receiving the data with every call.
+
+    Columns of strings are shared as int32 codes into a list of categories.
+    Tasks `attach` to the frame while they run and `detach` after, the blocks
+    are unlinked once the frame is closed and no task uses them.
+    """
+
+    live: Set[str] = set()  # ids of the frames of this process not closed
+
+    def __init__(self, data: pd.DataFrame) -> None:
+        self.blocks: List[SharedMemory] = []
+        columns = []
+        for name in data.columns:
+            values = data[name].to_numpy()
+            column: dict = {"name": name}
+            if values.dtype == object:
+                codes, categories = pd.factorize(values)
+                values = codes.astype(np.int32)
+                column["categories"] = categories.tolist()
+            block = SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, values.dtype, buffer=block.buf)[:] = values
+            column.update(block=block.name, dtype=values.dtype.str)
+            columns.append(column)
+            self.blocks.append(block)
+        self.descriptor = {
+            "id": uuid.uuid4().hex,
+            "rows": len(data),
+            "columns": columns,
+        }
+        self.tasks = 0
+        self.closed = False
+        self._lock = threading.Lock()
+        SharedFrame.live.add(self.descriptor["id"])
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"{cls}({self.descriptor['id']})"
+
+    @property
+    def nbytes(self) -> int:
+        return sum(block.size for block in self.blocks)
+
+    def attach(self) -> dict:
+        with self._lock:
+            if self.closed:
+                raise RuntimeError(f"{self} is closed.")
+            self.tasks += 1
+            return self.descriptor
+
+    def detach(self) -> None:
+        with self._lock:
+            self.tasks -= 1
+            if self.closed and not self.tasks:
+                self._unlink()
+
+    def close(self) -> None:
+        with self._lock:
+            self.closed = True
+            SharedFrame.live.discard(self.descriptor["id"])
+            if not self.tasks:
+                self._unlink()
+
+    def _unlink(self) -> None:
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def attach_frame(descriptor: Mapping) -> Tuple[pd.DataFrame, List[SharedMemory]]:
+    """Rebuild a shared DataFrame in this process, over read-only views of
+    the blocks, which must stay open as long as the frame is used."""
+    data, blocks = {}, []
+    for column in descriptor["columns"]:
+        # Pool processes share the server's resource tracker, which unlinks
+        # blocks the server did not release when everything exits
+        block = SharedMemory(name=column["block"])
+        shape = (descriptor["rows"],)
+        values = np.ndarray(shape, np.dtype(column["dtype"]), buffer=block.buf)
+        values.flags.writeable = False
+        if "categories" in column:
+            values = pd.Categorical.from_codes(values, column["categories"])
+        data[column["name"]] = values
+        blocks.append(block)
+    return pd.DataFrame(data, copy=False), blocks
+
+
+class ComputePool:
+    """Pool of processes running the CPU-bound worker methods of a server, so
+    that concurrent requests are not serialized by the GIL."""
+
+    def __init__(self, processes: int) -> None:
+        self.processes = processes
+        context = multiprocessing.get_context("spawn")  # the server is threaded
+        self._executor = ProcessPoolExecutor(processes, mp_context=context)
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"{cls}(processes={self.processes})"
+
+    def run(self, worker, method: str, args: tuple, kwargs: dict) -> Any:
+        shared = worker.share()
+        try:
+            future = self._executor.submit(
+                run_in_process,
+                type(worker),
+                worker.name,
+                worker.params,
+                shared.descriptor,
+                SharedFrame.live.copy(),
+                method,
+                args,
+                kwargs,
+            )
+            result, pid, nbytes = future.result()
+        finally:
+            shared.detach()
+        worker.process_nbytes[pid] = nbytes
+        return result
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
+
+
+_workers: "OrderedDict[str, Tuple[Any, List[SharedMemory]]]" = OrderedDict()
+
+
+def run_in_process(
+    cls: type,
+    name: str,
+    params: Mapping,
+    descriptor: Mapping,
+    live_frames: Collection[str],
+    method: str,
+    args: tuple,
+    kwargs: dict,
+) -> Tuple[Any, int, int]:
+    """Run a method on this process's worker over a shared frame, returning
+    the result, the process id and the bytes the worker holds of its own."""
+    for frame_id in [frame_id for frame_id in _workers if frame_id not in live_frames]:
+        forget_worker(frame_id)  # its server released the frame
+    if descriptor["id"] not in _workers:
+        data, blocks = attach_frame(descriptor)
+        worker = cls(name=name)
+        worker.set_data(params, data)
+        _workers[descriptor["id"]] = worker, blocks
+        while len(_workers) > PROCESS_CACHE_SIZE:
+            forget_worker(next(iter(_workers)))
+    _workers.move_to_end(descriptor["id"])
+    worker, _ = _workers[descriptor["id"]]
+    worker.params = params
+    result = getattr(worker, method)(*args, **kwargs)
+    # the frame is shared, the server counts it already
+    return result, os.getpid(), worker.memory_usage() - worker.data_nbytes()
+
+
+def forget_worker(frame_id: str) -> None:
+    worker, blocks = _workers.pop(frame_id)
+    del worker  # and the views of the blocks with it
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:  # some array still points to it, closed when freed
+            pass
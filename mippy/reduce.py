@@ -1,18 +1,10 @@
-from typing import Callable, Tuple, Any
+import asyncio
+from concurrent.futures import Executor, as_completed
+from typing import Awaitable, Callable, Iterable, List, Sequence, Tuple, Any
 
-from collections import namedtuple
 import numpy as np
 
-
-operators = {
-    None: lambda a, b: a,
-    "add": lambda a, b: a + b,
-    "add_dict": lambda a, b: {k: v + b[k] for k, v in a.items()},
-    "mediants": lambda a, b: [
-        Mean(np.array(ai[0]) + np.array(bi[0]), np.array(ai[1]) + np.array(bi[1]))
-        for ai, bi in zip(a, b)
-    ],
-}
+from mippy.tracing import span
 
 
 def rules(*rules_tup: Tuple[str]) -> Callable:
@@ -23,4 +15,122 @@ def rules(*rules_tup: Tuple[str]) -> Callable:
     return wrapper
 
 
-Mean = namedtuple("Mean", "numerator denominator")
+def own(value: Any) -> Any:
+    """Make a received value safe to accumulate into, decoded arrays are
+    read-only views of the message buffer."""
+    if isinstance(value, np.ndarray) and not value.flags.writeable:
+        return value.copy()
+    if isinstance(value, (list, tuple)):
+        return [own(item) for item in value]
+    return value
+
+
+def add_inplace(a: Any, b: Any) -> Any:
+    if (
+        isinstance(a, np.ndarray)
+        and np.can_cast(np.result_type(a, b), a.dtype)
+        and np.broadcast(a, b).shape == a.shape
+    ):
+        a += b
+        return a
+    return a + b
+
+
+def add_dict_inplace(a: dict, b: dict) -> dict:
+    for key, value in b.items():
+        a[key] = a[key] + value if key in a else value
+    return a
+
+
+def union_dict_inplace(a: dict, b: dict) -> dict:
+    """Sorted union of the lists of values under each key."""
+    for key, values in b.items():
+        a[key] = sorted(set(a.get(key, [])) | set(values))
+    return a
+
+
+def stack_r(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """R factor of two stacked matrices from their R factors (TSQR)."""
+    return np.linalg.qr(np.vstack([a, b]), mode="r")
+
+
+inplace_operators = {
+    None: lambda a, b: a,
+    "add": add_inplace,
+    "add_dict": add_dict_inplace,
+    "union_dict": union_dict_inplace,
+    "tsqr": stack_r,
+    "concat": lambda a, b: np.concatenate([a, b]),
+}
+
+
+class Reducer:
+    """Fold the results of one call into accumulators as they come, one per
+    return value, the first result received becomes the accumulator."""
+
+    def __init__(self, rules: Sequence[str]) -> None:
+        self.rules = rules
+        self.values: List[Any] = []
+
+    def add(self, result: Sequence) -> None:
+        if not self.values:
+            self.values = [own(value) for value in result]
+            return
+        self.values = [
+            inplace_operators[rule](acc, value)
+            for rule, acc, value in zip(self.rules, self.values, result)
+        ]
+
+
+class BatchReducer:
+    """Reducers for the calls of a batch, each folded under its own rules."""
+
+    def __init__(self, rules: Sequence[Sequence[str]]) -> None:
+        self.reducers = [Reducer(call_rules) for call_rules in rules]
+
+    def add(self, results: Sequence) -> None:
+        for reducer, result in zip(self.reducers, results):
+            reducer.add(result)
+
+    @property
+    def values(self) -> List[List[Any]]:
+        return [reducer.values for reducer in self.reducers]
+
+
+def fold_results(
+    executor: Executor, nodes: Iterable, call: Callable, reducer: Reducer, **trace
+) -> None:
+    """Call every node concurrently and fold each result as soon as it arrives.
+
+    Results are folded in node order, a result waits only for the ones before
+    it, so floating point sums do not depend on which server answered first.
+    """
+    futures = {executor.submit(call, node): i for i, node in enumerate(nodes)}
+    arrived, following = {}, 0
+    for future in as_completed(futures):
+        arrived[futures[future]] = future.result()
+        while following in arrived:
+            with span("reduce", **trace):
+                reducer.add(arrived.pop(following))
+            following += 1
+
+
+async def fold_results_async(
+    awaitables: Iterable[Awaitable], reducer: Reducer, **trace
+) -> None:
+    """Like `fold_results`, awaiting the results of the nodes on the running
+    loop. Calls still pending are cancelled when one fails or the fold is."""
+    pending = {asyncio.ensure_future(call): i for i, call in enumerate(awaitables)}
+    arrived, following = {}, 0
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                arrived[pending.pop(future)] = future.result()
+            while following in arrived:
+                with span("reduce", **trace):
+                    reducer.add(arrived.pop(following))
+                following += 1
+    finally:
+        for future in pending:
+            future.cancel()
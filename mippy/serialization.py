@@ -0,0 +1,74 @@
+import marshal
+import zlib
+from typing import Any, Mapping, Optional
+
+import numpy as np
+import Pyro5.api
+
+__all__ = ["SERIALIZER", "encode", "payload_size", "set_compression"]
+
+# marshal ships bytes and buffers as they are, serpent would base64 them
+SERIALIZER = "marshal"
+NDARRAY_CLASS = "numpy.ndarray"
+
+_compress_above: Optional[int] = None
+_compress_level = 1
+
+
+def set_compression(threshold: Optional[int], level: int = 1) -> None:
+    """Compress array buffers larger than `threshold` bytes, None disables it."""
+    global _compress_above, _compress_level
+    _compress_above = threshold
+    _compress_level = level
+
+
+def encode(obj: Any) -> Any:
+    """Turn a (nested) result into plain marshallable Python objects.
+
+    Arrays become a tagged dict holding dtype, shape and the raw buffer, which
+    is decoded back into an ndarray by Pyro on the receiving side.
+    """
+    if isinstance(obj, np.ndarray):
+        return encode_ndarray(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if type(obj) in (list, tuple, set):
+        return type(obj)(encode(o) for o in obj)
+    if isinstance(obj, tuple):  # namedtuples
+        return tuple(encode(o) for o in obj)
+    if isinstance(obj, Mapping):
+        return {key: encode(value) for key, value in obj.items()}
+    return obj
+
+
+def payload_size(encoded: Any) -> int:
+    """Size in bytes of an encoded payload, as marshal writes it."""
+    return len(marshal.dumps(encoded))
+
+
+def encode_ndarray(array: np.ndarray) -> dict:
+    if array.dtype.hasobject:
+        return array.tolist()
+    shape = array.shape
+    data = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+    compression = None
+    if _compress_above is not None and array.nbytes > _compress_above:
+        data = zlib.compress(data, _compress_level)
+        compression = "zlib"
+    return {
+        "__class__": NDARRAY_CLASS,
+        "dtype": array.dtype.str,
+        "shape": shape,
+        "data": data,
+        "compression": compression,
+    }
+
+
+def decode_ndarray(classname: str, dct: Mapping) -> np.ndarray:
+    data = dct["data"]
+    if dct["compression"] == "zlib":
+        data = zlib.decompress(data)
+    return np.frombuffer(data, dtype=np.dtype(dct["dtype"])).reshape(dct["shape"])
+
+
+Pyro5.api.register_dict_to_class(NDARRAY_CLASS, decode_ndarray)
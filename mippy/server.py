@@ -1,11 +1,30 @@
-from typing import Mapping, Type, Any
+import signal
+import sys
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import (
+    Any,
+    Dict as DictType,
+    Hashable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
 
-import numpy as np
 import Pyro5.api
+import Pyro5.callcontext
 import Pyro5.server
 from addict import Dict
 
-from mippy.database import DataBase, root
+from mippy.cache import DataCache, make_key
+from mippy.database import BACKENDS, DataBase, root
+from mippy.machinelearning import get_class
+from mippy.processes import ComputePool
+from mippy.serialization import encode, payload_size, set_compression
+from mippy.tracing import collect_spans, enable_tracing, span, tracing_enabled
 from mippy.worker import Worker
 
 __all__ = ["Server", "start_server"]
@@ -13,64 +32,224 @@ __all__ = ["Server", "start_server"]
 
 db_root = root / "dbs"
 
+DEFAULT_CACHE_SIZE = 1024 ** 3  # bytes
+
 
 class Server:
-    def __init__(self, name: str):
+    def __init__(
+        self,
+        name: str,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        backend: str = "sql",
+        immutable: bool = False,
+        db_root: Path = db_root,
+        stats_cache: bool = True,
+        processes: int = 0,
+        session_jobs: Optional[int] = None,
+    ):
         self.name = name
         print(f"Starting server {name}")
-        db_path = db_root / f"dataset-{name}.db"
-        self.db = DataBase(db_path=db_path)
+        db_path = Path(db_root) / f"dataset-{name}.db"
+        self.db = DataBase(
+            db_path=db_path,
+            backend=backend,
+            immutable=immutable,
+            stats_cache=stats_cache,
+        )
         self.datasets = self.db.get_datasets()
-        self.workers = get_workers()
-
-    def get_worker(self, params: Mapping, name: str) -> Type[Worker]:
+        self.cache = DataCache(max_bytes=cache_size, on_evict=self.release_worker)
+        # workers of the sessions over the cached ones, sharing their data
+        self._session_workers: DictType[Tuple[str, Hashable], Worker] = {}
+        self._workers_lock = threading.RLock()  # puts may call release_worker
+        # CPU-bound methods run in processes, at most `session_jobs` at a time
+        # for a session so that one experiment can't take all of them
+        self.compute_pool = ComputePool(processes) if processes else None
+        self.session_jobs = session_jobs
+        self._session_slots: DictType[str, threading.BoundedSemaphore] = {}
+        self._slots_lock = threading.Lock()
+
+    def get_worker(self, session: str, params: Mapping, name: str) -> Worker:
+        """The session's worker over the cached data, so that concurrent
+        sessions each have their parameters and state."""
         params = Dict(params)
-        worker = self.workers[name](name=self.name)
-        worker.load_data(params, self.db)
+        key = make_key(name, params)
+        with self._workers_lock:
+            if (cached := self.cache.get(key, session)) is None:
+                cached = get_class(name)(name=self.name)
+                cached.load_data(params, self.db)
+                self.cache.put(key, cached, cached.memory_usage(), session)
+            worker = self._session_workers.get((session, key))
+            if worker is None or not worker.shares_data(cached):
+                worker = cached.fork()
+                self._session_workers[session, key] = worker
+        worker.params = params
+        worker.trace = {"server": self.name, "session": session}
         return worker
 
+    def release_worker(self, worker: Worker) -> None:
+        worker.release()
+        with self._workers_lock:
+            for session_key, session_worker in list(self._session_workers.items()):
+                if session_worker.shares_data(worker):
+                    del self._session_workers[session_key]
+
     @Pyro5.api.expose
     def run_on_worker(
-        self, params: Mapping, task: str, method: Any, *args, **kwargs
+        self, session: str, params: Mapping, task: str, method: Any, *args, **kwargs
+    ) -> Any:
+        request = str(Pyro5.callcontext.current_context.correlation_id)
+        with span("run_on_worker", server=self.name, session=session, request=request):
+            return self._run_on_worker(session, params, task, method, *args, **kwargs)
+
+    def _run_on_worker(
+        self, session: str, params: Mapping, task: str, method: Any, *args, **kwargs
     ) -> Any:
-        worker = self.get_worker(params, task)
+        worker = self.get_worker(session, params, task)
+        try:
+            return self.run_method(worker, session, method, args, kwargs)
+        finally:
+            self.cache.resize(make_key(task, params), worker.memory_usage())
+
+    @Pyro5.api.expose
+    def run_batch(
+        self, session: str, params: Mapping, task: str, calls: List[list]
+    ) -> List[Any]:
+        """Run several `(method, args, kwargs)` calls on the same worker in a
+        single request, returning the results of each call."""
+        request = str(Pyro5.callcontext.current_context.correlation_id)
+        with span("run_batch", server=self.name, session=session, request=request):
+            worker = self.get_worker(session, params, task)
+            try:
+                return [
+                    self.run_method(worker, session, method, args, kwargs)
+                    for method, args, kwargs in calls
+                ]
+            finally:  # methods may have cached arrays on the worker
+                self.cache.resize(make_key(task, params), worker.memory_usage())
+
+    def run_method(
+        self, worker: Worker, session: str, method: str, args: tuple, kwargs: dict
+    ) -> Any:
+        trace = {"server": self.name, "session": session}
         method = getattr(worker, method)
-        if isinstance(results := method(*args, **kwargs), tuple):
-            results = tuple(
-                result.tolist() if isinstance(result, np.ndarray) else result
-                for result in results
-            )
-        else:
-            results = (
-                results.tolist() if isinstance(results, np.ndarray) else results,
-            )
+        with span("compute", method=method.__name__, **trace):
+            if self.runs_in_pool(worker, method):
+                with self.session_slot(session):
+                    results = self.compute_pool.run(
+                        worker, method.__name__, args, kwargs
+                    )
+            else:
+                results = method(*args, **kwargs)
+        if not isinstance(results, tuple):
+            results = (results,)
         if len(results) != len(method.rules):
             raise ValueError("Method rules should match the number of return values.")
+        with span("serialize", **trace) as serialize_span:
+            results = encode(results)
+            if tracing_enabled():  # marshalling is most of the serialization cost
+                serialize_span.set(bytes=payload_size(results))
         return results
 
+    def runs_in_pool(self, worker: Worker, method: Any) -> bool:
+        return (
+            self.compute_pool is not None
+            and getattr(method, "cpu_bound", False)
+            and not worker.params.get("streaming")
+        )
+
+    @contextmanager
+    def session_slot(self, session: str) -> Iterator[None]:
+        if self.session_jobs is None:
+            yield
+            return
+        with self._slots_lock:
+            if session not in self._session_slots:
+                semaphore = threading.BoundedSemaphore(self.session_jobs)
+                self._session_slots[session] = semaphore
+            semaphore = self._session_slots[session]
+        with semaphore:
+            yield
+
+    @Pyro5.api.expose
+    def close_session(self, session: str) -> None:
+        with self._workers_lock:
+            for session_key in list(self._session_workers):
+                if session_key[0] == session:
+                    del self._session_workers[session_key]
+        self.cache.close_session(session)
+        with self._slots_lock:
+            self._session_slots.pop(session, None)
+
+    def shutdown(self) -> None:
+        """Release the cached workers, unlinking their shared memory, and stop
+        the process pool."""
+        self.cache.clear()
+        if self.compute_pool is not None:
+            self.compute_pool.shutdown()
+
     @Pyro5.api.expose
     def get_datasets(self) -> set:
         return self.datasets
 
+    @Pyro5.api.expose
+    def set_tracing(self, enabled: bool, log: bool = False) -> None:
+        enable_tracing(enabled, log=log)
 
-def start_server(name: str) -> None:
-    daemon = Pyro5.api.Daemon()
-    ns = Pyro5.api.locate_ns()
-    ns.register(f"local-server.{name}", daemon.register(Server(name)))
-    daemon.requestLoop()
-
+    @Pyro5.api.expose
+    def collect_spans(self, session: Optional[str] = None) -> List[dict]:
+        return collect_spans(session)
 
-def get_workers():
-    import importlib
 
-    importlib.import_module(name="machinelearning", package="mippy")
-    return {w.__name__: w for w in Worker.__subclasses__()}
+def start_server(name: str, **kwargs) -> None:
+    daemon = Pyro5.api.Daemon()
+    ns = Pyro5.api.locate_ns()
+    server = Server(name, **kwargs)
+    ns.register(f"local-server.{name}", daemon.register(server))
+    # terminating unwinds the loop, so that shared memory is unlinked
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        daemon.requestLoop()
+    finally:
+        server.shutdown()
+        daemon.close()
 
 
 if __name__ == "__main__":
     import argparse
+    import logging
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--servername")
+    parser.add_argument(
+        "--cache-size", type=int, default=DEFAULT_CACHE_SIZE // 1024 ** 2, help="MB"
+    )
+    parser.add_argument(
+        "--compress-above", type=int, help="compress arrays larger than this (KB)"
+    )
+    parser.add_argument("--backend", choices=BACKENDS, default="sql")
+    parser.add_argument("--immutable", action="store_true")
+    parser.add_argument("--db-root", default=db_root)
+    parser.add_argument(
+        "--no-stats-cache", action="store_true", help="always compute moments"
+    )
+    parser.add_argument(
+        "--processes", type=int, default=0, help="run CPU-bound methods in processes"
+    )
+    parser.add_argument("--session-jobs", type=int, help="processes per session")
+    parser.add_argument("--trace", action="store_true", help="log spans as JSON")
     args = parser.parse_args()
-    start_server(args.servername)
+    if args.trace:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+        enable_tracing(log=True)
+    if args.compress_above is not None:
+        set_compression(args.compress_above * 1024)
+    start_server(
+        args.servername,
+        cache_size=args.cache_size * 1024 ** 2,
+        backend=args.backend,
+        immutable=args.immutable,
+        db_root=args.db_root,
+        stats_cache=not args.no_stats_cache,
+        processes=args.processes,
+        session_jobs=args.session_jobs,
+    )
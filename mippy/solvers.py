@@ -0,0 +1,59 @@
+import logging
+from typing import List
+
+import numpy as np
+
+__all__ = ["solve_spd", "solve_from_r"]
+
+logger = logging.getLogger(__name__)
+
+RCOND = 1e-12  # reciprocal condition number below which a factor is not trusted
+
+
+def solve_spd(A: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Solve A x = b for a symmetric positive definite A, a Gramian or the
+    Hessian of a convex loss, with a Cholesky factorization.
+
+    A is scaled to a unit diagonal first, features measured in different units
+    would otherwise make it look ill-conditioned. When it is singular or too
+    ill-conditioned, the minimum norm least squares solution is returned.
+    """
+    from scipy import linalg  # slow to import, the workers don't need it
+
+    scale = 1 / np.sqrt(np.where(np.diag(A) > 0, np.diag(A), 1))
+    A_scaled = A * scale[:, np.newaxis] * scale
+    b_scaled = b * (scale[:, np.newaxis] if b.ndim == 2 else scale)
+    try:
+        factor = linalg.cho_factor(A_scaled, check_finite=False)
+        rcond, _ = linalg.lapack.dpocon(factor[0], np.linalg.norm(A_scaled, 1))
+    except linalg.LinAlgError:
+        rcond = 0.0
+    if rcond < RCOND:
+        logger.warning("Ill-conditioned system (rcond=%.2e), solving by SVD", rcond)
+        x, *_ = np.linalg.lstsq(A_scaled, b_scaled, rcond=None)
+    else:
+        x = linalg.cho_solve(factor, b_scaled, check_finite=False)
+    return x * (scale[:, np.newaxis] if b.ndim == 2 else scale)
+
+
+def solve_from_r(R: np.ndarray, features: List[int], targets: List[int]) -> np.ndarray:
+    """Least squares coefficients of the `targets` columns on the `features`
+    columns of a matrix Z, given the R factor of the QR decomposition of Z.
+
+    The normal equations are never formed, so the condition number is not
+    squared as with a Gramian.
+    """
+    from scipy import linalg
+
+    R_model = np.linalg.qr(R[:, features + targets], mode="r")
+    n = len(features)
+    triangle, rhs = R_model[:n, :n], R_model[:n, n:]
+    if len(triangle) == n:
+        rcond, _ = linalg.lapack.dtrcon(triangle)
+    else:  # fewer rows than features
+        rcond = 0.0
+    if rcond < np.sqrt(RCOND):  # cond(R) ** 2 is the condition of the Gramian
+        logger.warning("Ill-conditioned system (rcond=%.2e), solving by SVD", rcond)
+        x, *_ = np.linalg.lstsq(triangle, rhs, rcond=None)
+        return x
+    return linalg.solve_triangular(triangle, rhs, check_finite=False)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Mapping, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+__all__ = ["Moments", "StatsCache", "cross_products"]
+
+INDEX = "index.json"
+FORMAT = 3  # of the index
+MEMORY_BYTES = 256 * 1024 ** 2  # Gramians kept loaded
+DISK_BYTES = 4 * 1024 ** 3  # Gramians kept on disk
+
+
+class Moments(NamedTuple):
+    """Number of rows, sums and cross products of some columns, all held in the
+    Gramian of the columns preceded by a column of ones."""
+
+    columns: Tuple[str, ...]
+    gramian: np.ndarray
+
+    @property
+    def n_obs(self) -> int:
+        return int(round(self.gramian[0, 0]))
+
+    @property
+    def sums(self) -> np.ndarray:
+        return self.gramian[0, 1:]
+
+    @property
+    def cross_products(self) -> np.ndarray:
+        return self.gramian[1:, 1:]
+
+    def select(self, columns: List[str]) -> "Moments":
+        idx = [0] + [self.columns.index(col) + 1 for col in columns]
+        return Moments(tuple(columns), self.gramian[np.ix_(idx, idx)])
+
+
+class StatsCache:
+    """Moments of the column sets requested so far, stored next to the
+    database and dropped as soon as its version changes.
+
+    Entries are looked up by datasets and filter. Rows with missing values are
+    dropped, so moments over a set of columns answer requests for a subset of
+    those columns only when no row was dropped, the rows being the same then.
+
+    At most `memory_bytes` of Gramians stay loaded, the least recently used
+    are dropped first, and at most `disk_bytes` stay on disk, the oldest
+    entries are deleted first.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        version: Callable[[], List[int]],
+        memory_bytes: int = MEMORY_BYTES,
+        disk_bytes: int = DISK_BYTES,
+    ) -> None:
+        self.path = path
+        self.version = version
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._index: Optional[dict] = None
+        self._loaded: "OrderedDict[str, Moments]" = OrderedDict()
+        self._loaded_bytes = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"{cls}({self.path})"
+
+    def get(
+        self,
+        datasets: List[str],
+        filter_: Optional[Mapping],
+        columns: List[str],
+        dtype: str,
+    ) -> Optional[Moments]:
+        key = make_key(datasets, filter_, dtype)
+        with self._lock:
+            self.refresh()
+            for entry in self._index["entries"].get(key, []):
+                same = set(entry["columns"]) == set(columns)
+                if same or entry["complete"] and set(columns) <= set(entry["columns"]):
+                    return self.load(entry).select(columns)
+        return None
+
+    def put(
+        self,
+        datasets: List[str],
+        filter_: Optional[Mapping],
+        moments: Moments,
+        complete: bool,
+        dtype: str,
+    ) -> None:
+        key = make_key(datasets, filter_, dtype)
+        name = hashlib.sha1(json.dumps([key, moments.columns]).encode()).hexdigest()
+        with self._lock:
+            self.refresh()
+            self.path.mkdir(parents=True, exist_ok=True)
+            np.save(self.path / f"{name}.npy", moments.gramian)
+            entries = [
+                entry
+                for entry in self._index["entries"].get(key, [])
+                if set(entry["columns"]) != set(moments.columns)
+            ]
+            entry = {
+                "columns": list(moments.columns),
+                "complete": complete,
+                "file": f"{name}.npy",
+                "nbytes": moments.gramian.nbytes,
+                "time": time.time(),
+            }
+            self._index["entries"][key] = [entry, *entries]
+            self.keep_loaded(entry["file"], moments)
+            self.prune()
+            tmp_path = self.path / f"{INDEX}.tmp{os.getpid()}"
+            tmp_path.write_text(json.dumps(self._index))
+            os.replace(tmp_path, self.path / INDEX)
+
+    def load(self, entry: dict) -> Moments:
+        if (moments := self._loaded.get(entry["file"])) is None:
+            gramian = np.load(self.path / entry["file"])
+            moments = Moments(tuple(entry["columns"]), gramian)
+        self.keep_loaded(entry["file"], moments)
+        return moments
+
+    def keep_loaded(self, name: str, moments: Moments) -> None:
+        self.forget(name)
+        self._loaded[name] = moments
+        self._loaded_bytes += moments.gramian.nbytes
+        while self._loaded_bytes > self.memory_bytes and self._loaded:
+            self.forget(next(iter(self._loaded)))
+
+    def forget(self, name: str) -> None:
+        if (moments := self._loaded.pop(name, None)) is not None:
+            self._loaded_bytes -= moments.gramian.nbytes
+
+    def prune(self) -> None:
+        """Delete the oldest entries until those left fit in `disk_bytes`."""
+        entries = self._index["entries"]
+        by_age = [(key, entry) for key in entries for entry in entries[key]]
+        by_age.sort(key=lambda item: item[1]["time"])
+        nbytes = sum(entry["nbytes"] for _, entry in by_age)
+        for key, entry in by_age:
+            if nbytes <= self.disk_bytes:
+                break
+            nbytes -= entry["nbytes"]
+            entries[key].remove(entry)
+            if not entries[key]:
+                del entries[key]
+            self.forget(entry["file"])
+            (self.path / entry["file"]).unlink(missing_ok=True)
+
+    def refresh(self) -> None:
+        version = self.version()
+        if self._index is None and (self.path / INDEX).exists():
+            self._index = json.loads((self.path / INDEX).read_text())
+        if self._index is None or self._index.get("format") != FORMAT:
+            self._index = {"version": None}  # none yet, or an older format
+        if self._index["version"] != version:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._index = {"format": FORMAT, "version": version, "entries": {}}
+            self._loaded.clear()
+            self._loaded_bytes = 0
+
+
+def make_key(datasets: List[str], filter_: Optional[Mapping], dtype: str) -> str:
+    """Datasets, filter and the dtype the moments were accumulated in."""
+    if not isinstance(datasets, str):
+        datasets = sorted(set(datasets))
+    return json.dumps([datasets, filter_, dtype], sort_keys=True)
+
+
+def cross_products(Y: np.ndarray, X: np.ndarray, block_size: int) -> np.ndarray:
+    """Compute Y.T @ X by column blocks, only the upper triangle when Y is X."""
+    symmetric = Y is X
+    sxy = np.empty((Y.shape[1], X.shape[1]))
+    for i in range(0, Y.shape[1], block_size):
+        rows = slice(i, i + block_size)
+        Y_block = np.ascontiguousarray(Y[:, rows])
+        for j in range(i if symmetric else 0, X.shape[1], block_size):
+            cols = slice(j, j + block_size)
+            sxy[rows, cols] = Y_block.T @ X[:, cols]
+            if symmetric and j != i:
+                sxy[cols, rows] = sxy[rows, cols].T
+    return sxy
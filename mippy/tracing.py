@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+__all__ = [
+    "span",
+    "enable_tracing",
+    "tracing_enabled",
+    "collect_spans",
+    "summarize",
+    "export_chrome_trace",
+    "export_otel_trace",
+]
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_log_spans = False
+_spans: List[dict] = []
+_lock = threading.Lock()
+
+
+class _NoSpan:
+    def __enter__(self) -> "_NoSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+    def set(self, **attrs) -> None:
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Span:
+    def __init__(self, name: str, attrs: dict) -> None:
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self) -> "Span":
+        self.start = time.time()
+        self._counter = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        record = {
+            "name": self.name,
+            "start": self.start,
+            "duration": time.perf_counter() - self._counter,
+            "pid": os.getpid(),
+            "thread": threading.get_ident(),
+        }
+        record.update(self.attrs)
+        if exc_info[0] is not None:
+            record["error"] = exc_info[0].__name__
+        with _lock:
+            _spans.append(record)
+        if _log_spans:
+            logger.info(json.dumps(record, default=str))
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+
+def span(name: str, **attrs):
+    """Time a block of code, a no-op unless tracing is enabled.
+
+    Attributes such as the run (session) and request ids are stored with the
+    span, more can be added from within the block with `set`.
+    """
+    if not _enabled:
+        return _NO_SPAN
+    return Span(name, attrs)
+
+
+def enable_tracing(enabled: bool = True, log: bool = False) -> None:
+    """Switch span recording on or off, `log` also emits every span as a JSON
+    line on the mippy.tracing logger."""
+    global _enabled, _log_spans
+    _enabled = enabled
+    _log_spans = log
+
+
+def tracing_enabled() -> bool:
+    return _enabled
+
+
+def collect_spans(session: Optional[str] = None, clear: bool = True) -> List[dict]:
+    """Return the recorded spans, only those of `session` if given."""
+    with _lock:
+        spans, kept = [], []
+        for record in _spans:
+            if session is None or record.get("session") == session:
+                spans.append(record)
+            else:
+                kept.append(record)
+        if clear:
+            _spans[:] = kept
+    return spans
+
+
+def summarize(spans: List[dict]) -> Dict[str, float]:
+    """Total duration per span name, in seconds."""
+    totals: Dict[str, float] = defaultdict(float)
+    for record in spans:
+        totals[record["name"]] += record["duration"]
+    return dict(totals)
+
+
+def export_chrome_trace(spans: List[dict], path: Path) -> None:
+    """Write spans in the Chrome trace event format (chrome://tracing, Perfetto)."""
+    events = [
+        {
+            "name": record["name"],
+            "ph": "X",
+            "ts": record["start"] * 1e6,
+            "dur": record["duration"] * 1e6,
+            "pid": record.get("server", record["pid"]),
+            "tid": record["thread"],
+            "args": attributes(record),
+        }
+        for record in spans
+    ]
+    Path(path).write_text(json.dumps({"traceEvents": events}, default=str))
+
+
+def export_otel_trace(spans: List[dict], path: Path) -> None:
+    """Write spans as OpenTelemetry-style JSON, one trace per session."""
+    records = [
+        {
+            "traceId": record.get("session", ""),
+            "spanId": record.get("request", ""),
+            "name": record["name"],
+            "startTimeUnixNano": int(record["start"] * 1e9),
+            "endTimeUnixNano": int((record["start"] + record["duration"]) * 1e9),
+            "attributes": attributes(record),
+        }
+        for record in spans
+    ]
+    Path(path).write_text(json.dumps(records, default=str))
+
+
+def attributes(record: dict) -> dict:
+    ignored = ("name", "start", "duration", "thread")
+    return {key: value for key, value in record.items() if key not in ignored}
@@ -1,42 +1,188 @@
+import copy
+import threading
 from abc import ABC
-from typing import List, Optional
+from typing import Any, Dict as DictType, Hashable, Iterator, List, Optional
 
 import Pyro5.api
+import numpy as np
 import pandas as pd
 from addict import Dict
 import mippy.reduce as reduce
+from mippy.parameters import get_columns
+from mippy.processes import SharedFrame
+from mippy.stats import Moments, cross_products
+from mippy.tracing import span
 
-__all__ = ["Worker"]
+__all__ = ["Worker", "cpu_bound"]
+
+STREAMING_CHUNKSIZE = 100_000  # rows
+BLOCK_SIZE = 512  # columns per block of the Gramians
+
+
+def cpu_bound(method: Any) -> Any:
+    """Mark a worker method to run in the server's process pool, if any."""
+    method.cpu_bound = True
+    return method
+
+
+class LoadedData:
+    """Data of a worker and everything derived from it, shared by the workers
+    of all the sessions that use the same data."""
+
+    def __init__(self, data: Optional[pd.DataFrame] = None) -> None:
+        self.data = data
+        self.nbytes = 0 if data is None else int(data.memory_usage(deep=True).sum())
+        self.arrays: DictType[Hashable, np.ndarray] = {}
+        self.shared: Optional[SharedFrame] = None
+        self.process_nbytes: DictType[int, int] = {}  # held in pool processes
+        self.lock = threading.Lock()
 
 
 class Worker(ABC):
     def __init__(self, name: str) -> None:
         self.name = name
         self.params: Optional[Dict] = None
-        self.data: Optional[pd.DataFrame] = None
+        self.db = None
+        self.trace: dict = {}
+        self._loaded = LoadedData()
 
     def __repr__(self) -> str:
         cls = type(self).__name__
         return f"{cls}({self.name})"
 
     def load_data(self, parameters: Dict, db) -> None:
+        """Attach the worker to its data, which is read on first use only, so
+        that calls answered from the statistics cache never read it."""
+        self.params = parameters
+        self.db = db
+        self._loaded = LoadedData()
+
+    def set_data(self, parameters: Dict, data: pd.DataFrame) -> None:
         self.params = parameters
-        self.data = db.read_data(parameters)
+        self._loaded = LoadedData(data)
+
+    def fork(self) -> "Worker":
+        """A worker for another session over the same data. The data and the
+        arrays derived from it are shared, parameters and the state of a run
+        are its own."""
+        worker = type(self)(self.name)
+        worker.params, worker.db, worker._loaded = self.params, self.db, self._loaded
+        return worker
+
+    def shares_data(self, other: "Worker") -> bool:
+        return self._loaded is other._loaded
+
+    def share(self) -> SharedFrame:
+        """Put the data in shared memory for the server's process pool. The
+        frame is returned attached, detach from it when done."""
+        data = self.data
+        loaded = self._loaded
+        with loaded.lock:
+            if loaded.shared is None:
+                loaded.shared = SharedFrame(data)
+            loaded.shared.attach()
+            return loaded.shared
+
+    def release(self) -> None:
+        loaded = self._loaded
+        with loaded.lock:
+            if loaded.shared is not None:
+                loaded.shared.close()
+                loaded.shared = None
+            loaded.process_nbytes.clear()
+
+    @property
+    def data(self) -> pd.DataFrame:
+        loaded = self._loaded
+        if loaded.data is None:
+            if self.params.get("streaming"):
+                raise RuntimeError("Streaming workers read data with iter_chunks.")
+            with loaded.lock:
+                if loaded.data is None:
+                    with span("load", **self.trace):
+                        data = self.db.read_data(self.params)
+                    loaded.nbytes = int(data.memory_usage(deep=True).sum())
+                    loaded.data = data
+        return loaded.data
+
+    @property
+    def process_nbytes(self) -> DictType[int, int]:
+        return self._loaded.process_nbytes
+
+    def data_nbytes(self) -> int:
+        """Bytes of the data in this process, not counting derived arrays."""
+        return self._loaded.nbytes
+
+    def memory_usage(self) -> int:
+        loaded = self._loaded
+        shared = loaded.shared.nbytes if loaded.shared is not None else 0
+        arrays = sum(arr.nbytes for arr in loaded.arrays.values())
+        processes = sum(loaded.process_nbytes.values())
+        return loaded.nbytes + shared + arrays + processes
 
     @Pyro5.api.expose
     @reduce.rules("add")
     def get_num_obs(self) -> int:
-        return len(self.data)
+        return sum(len(chunk.data) for chunk in self.iter_chunks())
+
+    def iter_chunks(self) -> Iterator["Worker"]:
+        """Workers over consecutive chunks of the data.
+
+        Yields the worker itself when the data is in memory. In streaming mode
+        the rows are read from the database in chunks of `chunksize` rows and
+        a copy of the worker is yielded for each, so that methods computing
+        additive statistics can be written once for both modes.
+        """
+        if not self.params.get("streaming") or self._loaded.data is not None:
+            yield self
+            return
+        chunksize = self.params.get("chunksize") or STREAMING_CHUNKSIZE
+        for data in self.db.iter_data(self.params, chunksize):
+            chunk = copy.copy(self)
+            chunk._loaded = LoadedData(data)
+            yield chunk
+
+    def get_moments(self) -> Moments:
+        """Moments of all the requested columns, all numerical, from the
+        server's statistics cache when they, or a superset, were computed
+        before on the same rows."""
+        columns = get_columns(self.params)
+        dtype = self.get_dtype().str
+        key = ("moments", tuple(columns), dtype)
+        if (gramian := self._loaded.arrays.get(key)) is not None:
+            return Moments(tuple(columns), gramian)
+        stats_cache = self.db.stats_cache
+        datasets, filter_ = self.params.datasets, self.params.filter
+        if stats_cache and (
+            moments := stats_cache.get(datasets, filter_, columns, dtype)
+        ):
+            return moments
+        block_size = self.params.get("block_size") or BLOCK_SIZE
+        gramian = np.zeros((len(columns) + 1, len(columns) + 1))
+        for chunk in self.iter_chunks():
+            Z = chunk.get_design_array(columns)
+            gramian += cross_products(Z, Z, block_size)
+        moments = Moments(tuple(columns), gramian)
+        self._loaded.arrays[key] = gramian
+        if stats_cache:
+            complete = moments.n_obs == self.db.count_rows(self.params)
+            stats_cache.put(datasets, filter_, moments, complete, dtype)
+        return moments
+
+    def iter_row_slices(
+        self, n_rows: int, max_rows: Optional[int] = None
+    ) -> Iterator[slice]:
+        chunksize = self.params.get("chunksize") or max(n_rows, 1)
+        chunksize = min(chunksize, max_rows or chunksize)
+        for start in range(0, n_rows, chunksize):
+            yield slice(start, start + chunksize)
 
     def get_design_matrix(
         self, columns: List[str], intercept: bool = True
     ) -> pd.DataFrame:
         X = self.data[columns]
         if intercept:
-            X["Intercept"] = 1
-            cols = list(X)
-            cols.insert(0, cols.pop(cols.index("Intercept")))  # Move intercept to front
-            X = X.loc[:, cols]
+            X = pd.concat([pd.Series(1, index=X.index, name="Intercept"), X], axis=1)
         return X
 
     def get_target_column(self, target: List[str], outcome: str) -> pd.DataFrame:
@@ -45,3 +191,34 @@ class Worker(ABC):
         outcome = target[0] + "_" + outcome
         y = y[outcome]
         return y
+
+    def get_design_array(
+        self, columns: List[str], intercept: bool = True
+    ) -> np.ndarray:
+        """Design matrix as a contiguous array, intercept first.
+
+        Built once per loaded data and shared by all calls, hence read-only.
+        The dtype is float64 unless the `dtype` parameter says otherwise.
+        """
+        dtype = self.get_dtype()
+        key = ("design", tuple(columns), intercept, dtype.str)
+        if (X := self._loaded.arrays.get(key)) is None:
+            X = np.empty((len(self.data), len(columns) + intercept), dtype=dtype)
+            if intercept:
+                X[:, 0] = 1
+            X[:, int(intercept) :] = self.data[columns].to_numpy(dtype=dtype)
+            X.flags.writeable = False
+            self._loaded.arrays[key] = X
+        return X
+
+    def get_dtype(self) -> np.dtype:
+        return np.dtype(self.params.get("dtype") or np.float64)
+
+    def get_target_array(self, target: List[str], outcome: str) -> np.ndarray:
+        """Read-only 0/1 indicator of `outcome` in the target column."""
+        key = ("target", tuple(target), outcome)
+        if (y := self._loaded.arrays.get(key)) is None:
+            y = (self.data[target[0]] == outcome).to_numpy(dtype=np.float64)
+            y.flags.writeable = False
+            self._loaded.arrays[key] = y
+        return y
@@ -1,108 +1,563 @@
+import asyncio
+import logging
+import math
 import operator
 import functools
-from typing import List, Set, Optional
+import random
+import statistics
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    DefaultDict,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Union,
+)
 
-import numpy as np
-import Pyro5.api
+import Pyro5.callcontext
+import Pyro5.errors
 from addict import Dict
 
-from mippy.reduce import operators
+from mippy.connections import ConnectError, connection_manager
+from mippy.reduce import BatchReducer, Reducer, fold_results_async
+from mippy.serialization import encode, payload_size
+from mippy.tracing import collect_spans, enable_tracing, span, tracing_enabled
 
 
-__all__ = ["WorkerProxy", "WorkerPool"]
+__all__ = ["WorkerProxy", "WorkerPool", "AsyncWorkerPool", "run_sync"]
+
+logger = logging.getLogger(__name__)
+
+RPC_THREADS = 64  # calls to servers in flight, over all pools
+RETRIES = 2
+BACKOFF = 0.1  # seconds
+SLOW_FACTOR = 2.0  # median latency over the median of all servers
+SLOW_MARGIN = 0.1  # seconds, below which no server is slow
+CLOSE_TIMEOUT = 2.0  # seconds given to a server to close a session
+
+rpc_executor = ThreadPoolExecutor(RPC_THREADS, thread_name_prefix="mippy-rpc")
 
 
 class WorkerProxy:
-    def __init__(self, server_name: str, *, params: Dict, worker_kind: str):
-        self._proxy = Pyro5.api.Proxy(f"PYRONAME:{server_name}")
+    def __init__(
+        self,
+        server_name: str,
+        *,
+        params: Dict,
+        worker_kind: str,
+        session: str,
+        timeout: Optional[float] = None,
+    ):
         self.worker_kind = worker_kind
-        self._datasets: Optional[Set[str]] = None
         self.server_name = server_name
         self.params = params
+        self.session = session
+        self.timeout = timeout
 
     def __getattr__(self, method):
         return functools.partial(self._run, method)
 
     def _run(self, method: str, *args, **kwargs):
-        return self._proxy.run_on_worker(
-            self.params, self.worker_kind, method, *args, **kwargs
+        with self._request(method):
+            return connection_manager.call_within(
+                self.timeout,
+                self.server_name,
+                "run_on_worker",
+                self.session,
+                encode(self.params),
+                self.worker_kind,
+                method,
+                *args,
+                **kwargs,
+            )
+
+    def run_batch(self, calls: List[tuple]) -> list:
+        """Run `(method, args, kwargs)` calls in one request."""
+        methods = ",".join(method for method, _, _ in calls)
+        with self._request(methods):
+            return connection_manager.call_within(
+                self.timeout,
+                self.server_name,
+                "run_batch",
+                self.session,
+                encode(self.params),
+                self.worker_kind,
+                calls,
+            )
+
+    @contextmanager
+    def _request(self, method: str) -> Iterator[None]:
+        request = uuid.uuid4()  # sent along by Pyro as the call's correlation id
+        Pyro5.callcontext.current_context.correlation_id = request
+        trace = {"server": self.server_name, "session": self.session}
+        with span("rpc", method=method, request=str(request), **trace):
+            yield
+
+    def close(self, timeout: Optional[float] = None) -> None:
+        connection_manager.call_within(
+            timeout, self.server_name, "close_session", self.session
+        )
+
+    def set_tracing(self, enabled: bool, log: bool = False) -> None:
+        connection_manager.call_within(
+            self.timeout, self.server_name, "set_tracing", enabled, log
+        )
+
+    def collect_spans(self) -> List[dict]:
+        return connection_manager.call_within(
+            self.timeout, self.server_name, "collect_spans", self.session
         )
 
     @property
     def datasets(self) -> Set[str]:
-        if self._datasets:
-            return self._proxy.get_datasets()
-        else:
-            self._datasets = self._proxy.get_datasets()
-            return self._datasets  # type: ignore  # mypy is confused somehow
+        return connection_manager.get_datasets(self.server_name, self.timeout)
 
 
-class WorkerPool:
-    def __init__(self, server_names: List[str], params: Dict, master: str):
-        input_datasets = set(params.datasets)
-        self._datasets = None
+class ServerStats:
+    """Latencies of the attempts of a pool to call one server, failed ones
+    included, and its failures."""
+
+    def __init__(self) -> None:
+        self.latencies: List[float] = []
+        self.retries = 0
+        self.timeouts = 0
+        self.hedged = 0
+        self.hedges_won = 0
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"{cls}(calls={len(self.latencies)}, median={self.median})"
+
+    @property
+    def median(self) -> Optional[float]:
+        return statistics.median(self.latencies) if self.latencies else None
+
+
+class AsyncWorkerPool:
+    """Workers of a run on an event loop: `await pool.method(*args)` calls the
+    method on every server concurrently and reduces the results, so that one
+    loop can drive many runs.
+
+    Calls to servers block, they run on threads shared by all pools. Rounds
+    taking longer than `timeout` seconds, or ending after `deadline` seconds
+    from the start of the run, raise `asyncio.TimeoutError`. A cancelled
+    round stops waiting for the servers and drops their results.
+
+    A server not answering a call within `call_timeout` seconds raises
+    `Pyro5.errors.TimeoutError`: the call may still be running there, it is
+    not sent again. A server that can't be reached is tried again up to
+    `retries` times, waiting `backoff` seconds, doubled at every attempt, the
+    only retries over a connection. `replicas` maps servers to others
+    holding the same data: a call still running after `hedge_after` seconds
+    is also sent to a replica and the first answer is kept. The latencies are
+    kept per server, see `report`.
+    """
+
+    def __init__(
+        self,
+        server_names: List[str],
+        params: Dict,
+        master: str,
+        timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+        call_timeout: Optional[float] = None,
+        retries: int = RETRIES,
+        backoff: float = BACKOFF,
+        replicas: Optional[Mapping[str, List[str]]] = None,
+        hedge_after: Optional[float] = None,
+    ):
         self.worker_kind = master.replace("Master", "Worker")
-        self._workers = [
-            worker
-            for name in server_names
-            if contains_any_dataset(
-                worker := WorkerProxy(
-                    name, params=params, worker_kind=self.worker_kind
-                ),
-                datasets=input_datasets,
+        self.session = uuid.uuid4().hex
+        self.params = params
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self.call_timeout = call_timeout
+        self._workers = [self._proxy(name, call_timeout) for name in server_names]
+        self.replicas = {
+            name: [self._proxy(replica, call_timeout) for replica in replica_names]
+            for name, replica_names in (replicas or {}).items()
+        }
+        self.stats: DefaultDict[str, ServerStats] = defaultdict(ServerStats)
+        self._opened = False
+        self._ends: Optional[float] = None
+
+    def _proxy(self, name: str, timeout: Optional[float]) -> WorkerProxy:
+        return WorkerProxy(
+            name,
+            params=self.params,
+            worker_kind=self.worker_kind,
+            session=self.session,
+            timeout=timeout,
+        )
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"{cls}({self.worker_kind}, session={self.session})"
+
+    def __len__(self):
+        return len(self._workers)
+
+    def __iter__(self):
+        return iter(self._workers)
+
+    def __getitem__(self, item):
+        return self._workers[item]
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+        return functools.partial(self.call, method)
+
+    async def open(self) -> "AsyncWorkerPool":
+        """Keep only the servers holding some of the requested datasets, done
+        before the first round if not called. The deadline starts here and
+        bounds this discovery too, as `timeout` does."""
+        if not self._opened:
+            if self.deadline is not None:
+                self._ends = time.monotonic() + self.deadline
+            self._workers = await asyncio.wait_for(
+                self._in_thread(self._select_workers), self.round_timeout()
             )
+            self._opened = True
+        return self
+
+    def _select_workers(self) -> List[WorkerProxy]:
+        input_datasets = set(self.params.datasets)
+        workers = [
+            worker
+            for worker in self._workers
+            if contains_any_dataset(worker, datasets=input_datasets)
         ]
-        if missing := input_datasets - self.datasets:
+        datasets = functools.reduce(
+            operator.or_, (worker.datasets for worker in workers), set()
+        )
+        if missing := input_datasets - datasets:
             msg = f"Dataset(s) '{missing}' cannot be found on any server."
             raise ValueError(msg)
+        primaries = {worker.server_name for worker in self._workers}
+        for worker in workers:
+            for replica in self.replicas.get(worker.server_name, []):
+                if replica.server_name in primaries:
+                    msg = f"{replica.server_name} is both a server and a replica."
+                    raise ValueError(msg)
+                if (
+                    replica.datasets & input_datasets
+                    != worker.datasets & input_datasets
+                ):
+                    msg = (
+                        f"{replica.server_name} doesn't replicate {worker.server_name}."
+                    )
+                    raise ValueError(msg)
+        return workers
+
+    async def call(self, method: str, *args, **kwargs):
+        await self.open()
+        with span("round", session=self.session, method=method):
+            return await asyncio.wait_for(
+                self._run_round(method, *args, **kwargs), self.round_timeout()
+            )
+
+    async def _run_round(self, method: str, *args, **kwargs):
+        with span("serialize", session=self.session) as serialize_span:
+            args, kwargs = encode(args), encode(kwargs)
+            if tracing_enabled():  # marshalling is most of the serialization cost
+                serialize_span.set(bytes=payload_size((args, kwargs)) * len(self))
+        reducer = Reducer(self.rules(method))
+        await fold_results_async(
+            (self._call_node(node, method, *args, **kwargs) for node in self),
+            reducer,
+            session=self.session,
+            method=method,
+        )
+        if len(reducer.values) == 1:
+            return reducer.values[0]
+        return reducer.values
+
+    async def batch(self, *calls: Union[str, tuple]) -> list:
+        """Run several methods in a single round trip to each server.
+
+        Calls are method names or `(method, *args)` tuples, run in order on
+        each server. Returns the result of each call, reduced under its own
+        rules, for instance
+
+            n_obs, (sx, sxx) = await pool.batch("get_num_obs", "get_local_sums")
+        """
+        await self.open()
+        calls = [(call,) if isinstance(call, str) else call for call in calls]
+        methods = [method for method, *_ in calls]
+        with span("round", session=self.session, method=",".join(methods)):
+            with span("serialize", session=self.session) as serialize_span:
+                calls = [(method, encode(args), {}) for method, *args in calls]
+                if tracing_enabled():
+                    serialize_span.set(bytes=payload_size(calls) * len(self))
+            reducer = BatchReducer([self.rules(method) for method in methods])
+            await asyncio.wait_for(
+                fold_results_async(
+                    (self._call_node(node, "run_batch", calls) for node in self),
+                    reducer,
+                    session=self.session,
+                    method=",".join(methods),
+                ),
+                self.round_timeout(),
+            )
+        return [values[0] if len(values) == 1 else values for values in reducer.values]
+
+    def round_timeout(self) -> Optional[float]:
+        if self._ends is None:
+            return self.timeout
+        remaining = max(self._ends - time.monotonic(), 0.0)
+        return remaining if self.timeout is None else min(self.timeout, remaining)
+
+    async def _call_node(self, node: WorkerProxy, method: str, *args, **kwargs):
+        stats = self.stats[node.server_name]
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._hedged(node, method, args, kwargs)
+            except Pyro5.errors.TimeoutError:
+                stats.timeouts += 1
+                raise
+            except ConnectError:  # nothing was sent
+                if attempt == self.retries:
+                    raise
+                stats.retries += 1
+                delay = self.backoff * 2 ** attempt
+                await asyncio.sleep(random.uniform(delay / 2, delay))
+
+    async def _hedged(self, node: WorkerProxy, method: str, args, kwargs):
+        """Call a server and, if it is slow, a replica too, first answer wins."""
+        call = asyncio.ensure_future(self._attempt(node, method, args, kwargs))
+        replicas = self.replicas.get(node.server_name)
+        if not replicas or self.hedge_after is None:
+            return await call
+        done, _ = await asyncio.wait({call}, timeout=self.hedge_after)
+        if done:
+            return call.result()
+        self.stats[node.server_name].hedged += 1
+        replica = random.choice(replicas)
+        hedge = asyncio.ensure_future(self._attempt(replica, method, args, kwargs))
+        pending = {call, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                answered = [f for f in (call, hedge) if f in done and not f.exception()]
+                if answered:
+                    if answered[0] is hedge:
+                        self.stats[node.server_name].hedges_won += 1
+                    return answered[0].result()
+            return call.result()  # both failed, raise the server's error
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _attempt(self, node: WorkerProxy, method: str, args, kwargs):
+        """Call a server, recording the time it took, or was waited for when
+        it failed or was given up on, so that failing servers look slow too."""
+        start = time.monotonic()
+        try:
+            return await self._in_thread(getattr(node, method), *args, **kwargs)
+        finally:
+            self.stats[node.server_name].latencies.append(time.monotonic() - start)
+
+    def report(self, slow_factor: float = SLOW_FACTOR) -> List[dict]:
+        """Calls, latencies, retries and hedges per server, slowest first.
+
+        Servers whose median latency is more than `slow_factor` times the
+        median over all servers, and `SLOW_MARGIN` above it, are marked slow.
+        """
+        medians = [stats.median for stats in self.stats.values() if stats.latencies]
+        typical = statistics.median(medians) if medians else None
+        rows = []
+        for name, stats in self.stats.items():
+            latencies = sorted(stats.latencies) or [None]
+            median = stats.median
+            rows.append(
+                {
+                    "server": name,
+                    "calls": len(stats.latencies),
+                    "median": median,
+                    "p95": latencies[math.ceil(0.95 * len(latencies)) - 1],
+                    "max": latencies[-1],
+                    "retries": stats.retries,
+                    "timeouts": stats.timeouts,
+                    "hedged": stats.hedged,
+                    "hedges_won": stats.hedges_won,
+                    "slow": median is not None
+                    and is_slow(median, typical, slow_factor),
+                }
+            )
+        return sorted(rows, key=lambda row: -(row["median"] or 0))
+
+    async def close(self) -> None:
+        """Close the session on every server, giving up with a warning on the
+        ones not answering within `call_timeout`, `timeout` or `CLOSE_TIMEOUT`
+        seconds, whichever is shortest."""
+        replicas = [replica for nodes in self.replicas.values() for replica in nodes]
+        nodes = [*self, *replicas]
+        limits = [self.call_timeout, self.timeout, CLOSE_TIMEOUT]
+        timeout = min(limit for limit in limits if limit is not None)
+        results = await asyncio.gather(
+            *(self._in_thread(node.close, timeout) for node in nodes),
+            return_exceptions=True,
+        )
+        for node, result in zip(nodes, results):
+            if isinstance(result, Pyro5.errors.CommunicationError):
+                logger.warning(
+                    "Session %s not closed on %s: %s",
+                    self.session,
+                    node.server_name,
+                    result,
+                )
+            elif isinstance(result, BaseException):
+                raise result
+        if slow := [row["server"] for row in self.report() if row["slow"]]:
+            logger.warning("Slow servers in session %s: %s", self.session, slow)
+
+    @staticmethod
+    async def _in_thread(function: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(function, *args, **kwargs)
+        return await loop.run_in_executor(rpc_executor, call)
+
+    # Tracing is for debugging, its calls block
+
+    def enable_tracing(self, enabled: bool = True, log: bool = False) -> None:
+        """Record spans here and on every server."""
+        enable_tracing(enabled, log=log)
+        for node in self:
+            node.set_tracing(enabled, log)
+
+    def collect_spans(self) -> List[dict]:
+        """Spans of this pool's run, from the client and from every server."""
+        spans = collect_spans(self.session)
+        for node in self:
+            spans.extend(node.collect_spans())
+        return sorted(spans, key=lambda record: record["start"])
+
+    @property
+    def datasets(self) -> Set[str]:
+        return functools.reduce(operator.or_, (node.datasets for node in self), set())
+
+    def rules(self, method: str) -> tuple:
+        from mippy.machinelearning import get_rules
+
+        return get_rules(self.worker_kind)[method]
+
+
+class WorkerPool:
+    """Blocking interface to an `AsyncWorkerPool`, run on a background loop."""
+
+    def __init__(self, server_names: List[str], params: Dict, master: str, **options):
+        self.pool = AsyncWorkerPool(server_names, params, master, **options)
+        run_sync(self.pool.open())
+
+    @classmethod
+    def wrap(cls, pool: AsyncWorkerPool) -> "WorkerPool":
+        """Blocking interface to an existing pool."""
+        self = cls.__new__(cls)
+        self.pool = pool
+        run_sync(pool.open())
+        return self
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"{cls}({self.worker_kind}, session={self.session})"
 
     def __len__(self):
-        return len(self._workers)
+        return len(self.pool)
 
     def __iter__(self):
-        return iter(self._workers)
+        return iter(self.pool)
 
     def __getitem__(self, item):
-        return self._workers[item]
+        return self.pool[item]
 
     def __getattr__(self, method):
+        if method.startswith("_") or method == "pool":
+            raise AttributeError(method)
         return functools.partial(self._run, method)
 
     def _run(self, method: str, *args, **kwargs):
-        args = tuple(
-            arg.tolist() if isinstance(arg, np.ndarray) else arg for arg in args
-        )
-        kwargs = {
-            key: value.tolist() if isinstance(value, np.ndarray) else value
-            for key, value in kwargs.items()
-        }
-        result = [getattr(node, method)(*args, **kwargs) for node in self]
-        result = [
-            [np.array(n[i]) if isinstance(n[i], list) else n[i] for n in result]
-            for i in range(len(result[0]))
-        ]
-        return self.reduce(result, method)
+        return run_sync(self.pool.call(method, *args, **kwargs))
+
+    def batch(self, *calls: Union[str, tuple]) -> list:
+        return run_sync(self.pool.batch(*calls))
+
+    def close(self) -> None:
+        run_sync(self.pool.close())
+
+    def enable_tracing(self, enabled: bool = True, log: bool = False) -> None:
+        self.pool.enable_tracing(enabled, log)
+
+    def collect_spans(self) -> List[dict]:
+        return self.pool.collect_spans()
+
+    def report(self, slow_factor: float = SLOW_FACTOR) -> List[dict]:
+        return self.pool.report(slow_factor)
+
+    @property
+    def worker_kind(self) -> str:
+        return self.pool.worker_kind
+
+    @property
+    def session(self) -> str:
+        return self.pool.session
 
     @property
     def datasets(self) -> Set[str]:
-        if self._datasets:
-            return self._datasets
-        else:
-            self._datasets = functools.reduce(
-                operator.or_, (node.datasets for node in self)
+        return self.pool.datasets
+
+    def rules(self, method: str) -> tuple:
+        return self.pool.rules(method)
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+
+
+def background_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(
+                target=_loop.run_forever, name="mippy-loop", daemon=True
             )
-            return self._datasets  # type: ignore  # mypy is confused somehow
+            _loop_thread.start()
+    return _loop
 
-    def reduce(self, result, method):
-        from mippy.machinelearning import reduction_rules
 
-        rules = reduction_rules[self.worker_kind][method]
-        merged = [
-            functools.reduce(operators[rule], res) for rule, res in zip(rules, result)
-        ]
-        if len(merged) == 1:
-            return merged[0]
-        return merged
+def run_sync(coroutine: Coroutine) -> Any:
+    """Run a coroutine on the background loop and wait for its result."""
+    loop = background_loop()
+    if threading.current_thread() is _loop_thread:
+        coroutine.close()
+        raise RuntimeError("Blocking call on the background loop, await it.")
+    future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+    try:
+        return future.result()
+    except BaseException:  # interrupted, don't leave the run going
+        future.cancel()
+        raise
+
+
+def is_slow(median: float, typical: float, slow_factor: float) -> bool:
+    return median > slow_factor * typical and median - typical > SLOW_MARGIN
 
 
 def contains_any_dataset(worker: WorkerProxy, datasets: Set[str]):